@@ -0,0 +1,149 @@
+import json
+import logging
+import queue
+import threading
+import time
+
+from typing import List, NamedTuple, Optional
+
+log = logging.getLogger("amethyst.accesslog")
+
+FORMATS = ("combined", "json")
+
+
+class AccessLogEntry(NamedTuple):
+    time: float
+    peer: str
+    host: str
+    url: str
+    status: int
+    meta: str
+    bytes: int
+    duration: float
+
+
+def format_combined(entry: AccessLogEntry) -> str:
+    # Like the combined log format of web servers, as far as Gemini goes:
+    # there's no method, referrer or user agent, but there is a meta line.
+    # The URL and meta come from clients and scripts, so they're quoted
+    # the same way as in JSON, escaping quotes and control characters.
+    timestamp = time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(entry.time))
+    url = json.dumps(entry.url, ensure_ascii=False)
+    meta = json.dumps(entry.meta, ensure_ascii=False)
+    return (
+        f"{entry.peer} - - [{timestamp}] {url} {entry.status} "
+        f"{entry.bytes} {meta} {entry.duration:.6f}"
+    )
+
+
+def format_json(entry: AccessLogEntry) -> str:
+    return json.dumps(entry._asdict(), separators=(",", ":"))
+
+
+class AccessLog:
+    """Writes access log entries in batches, from a thread of its own.
+
+    Recording an entry never blocks: entries go into a bounded queue, and
+    whatever doesn't fit is counted in `dropped` and discarded. Without a
+    path, entries are passed on to the "amethyst.access" logger instead,
+    still from the writer thread.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        format: str = "combined",
+        buffer_size: int = 10000,
+        batch_size: int = 256,
+    ):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown access log format {format!r}")
+
+        self.path = path
+        self.format = format_json if format == "json" else format_combined
+        self.batch_size = batch_size
+
+        self.logger = logging.getLogger("amethyst.access")
+        self.queue: "queue.Queue[Optional[AccessLogEntry]]" = queue.Queue(buffer_size)
+        self.dropped = 0
+
+        self.closed = False
+        self.reopen_requested = False
+
+        self.thread = threading.Thread(
+            target=self._run, name="amethyst-access-log", daemon=True
+        )
+        self.thread.start()
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            cfg.get("path"),
+            cfg.get("format", "combined"),
+            cfg.get("buffer_size", 10000),
+        )
+
+    def record(self, entry: AccessLogEntry):
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def reopen(self):
+        # For log rotation: the file is reopened before the next batch.
+        self.reopen_requested = True
+
+    def close(self):
+        # Writes out whatever's still queued, then stops the thread.
+        self.queue.put(None)
+        self.thread.join()
+
+    def _next_batch(self) -> List[AccessLogEntry]:
+        # Blocks for the first entry, then takes whatever else is waiting.
+        batch: List[AccessLogEntry] = []
+
+        entry = self.queue.get()
+        while entry is not None:
+            batch.append(entry)
+            if len(batch) >= self.batch_size:
+                return batch
+
+            try:
+                entry = self.queue.get_nowait()
+            except queue.Empty:
+                return batch
+
+        self.closed = True
+        return batch
+
+    def _open(self):
+        if self.path is None:
+            return None
+
+        return open(self.path, "a", buffering=1024 * 1024)
+
+    def _run(self):
+        f = self._open()
+
+        try:
+            while not self.closed:
+                batch = self._next_batch()
+
+                if self.reopen_requested and f is not None:
+                    self.reopen_requested = False
+                    f.close()
+                    f = self._open()
+
+                try:
+                    if f is None:
+                        for entry in batch:
+                            self.logger.info(self.format(entry))
+                    else:
+                        f.write("".join(f"{self.format(entry)}\n" for entry in batch))
+                        f.flush()
+                except Exception:
+                    log.exception("Failed to write access log")
+
+        finally:
+            if f is not None:
+                f.close()
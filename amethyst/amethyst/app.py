@@ -0,0 +1,198 @@
+import asyncio
+import dataclasses
+import importlib
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import time
+
+from types import ModuleType
+from typing import Dict, Optional, Tuple
+
+from .request import Context
+from .resource import Resource
+from .response import Response, Status
+
+
+class AppModule:
+    """A module holding an application callable, reloaded when it changes.
+
+    Only the module's own file is watched; modules it imports are not
+    reloaded along with it. Loading runs module code, so it's done on the
+    server's executor, one thread at a time.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        attr: str,
+        path: Optional[str] = None,
+        reload_interval: Optional[float] = 1.0,
+    ):
+        self.name = name
+        self.attr = attr
+        self.path = path
+        self.reload_interval = reload_interval
+
+        self.module: Optional[ModuleType] = None
+        self.app: Optional[Resource] = None
+        self.mtime_ns: Optional[int] = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+        self.load()
+
+    def _mtime_ns(self) -> Optional[int]:
+        filename = getattr(self.module, "__file__", None)
+        if filename is None:
+            return None
+
+        return os.stat(filename).st_mtime_ns
+
+    def load(self):
+        if self.path is not None:
+            # Modules loaded from an app directory get a name of their own,
+            # so they can't clash with (or replace) anything importable.
+            spec = importlib.util.spec_from_file_location(self.name, self.path)
+            assert spec is not None and spec.loader is not None
+
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[self.name] = module
+            try:
+                spec.loader.exec_module(module)
+            except BaseException:
+                if self.module is None:
+                    del sys.modules[self.name]
+                else:
+                    sys.modules[self.name] = self.module
+                raise
+
+            self.module = module
+
+        elif self.module is None:
+            self.module = importlib.import_module(self.name)
+
+        else:
+            self.module = importlib.reload(self.module)
+
+        app = self.module
+        for part in self.attr.split("."):
+            app = getattr(app, part)
+
+        self.app = app
+        self.mtime_ns = self._mtime_ns()
+        self.checked_at = time.monotonic()
+
+    def get(self) -> Resource:
+        if self.reload_interval is not None:
+            with self.lock:
+                now = time.monotonic()
+
+                if now - self.checked_at >= self.reload_interval:
+                    self.checked_at = now
+
+                    if self._mtime_ns() != self.mtime_ns:
+                        self.load()
+
+        assert self.app is not None
+        return self.app
+
+
+class AppResource:
+    """Serves requests from Python callables running in the server itself.
+
+    Either mount one callable with `app` ("package.module:callable"), or a
+    directory of modules with `root`, where the first component of the path
+    picks the module (index.py for the directory itself) and `callable`
+    names the attribute to call. Applications are called like any other
+    resource, as `await app(ctx)`, and return a Response, whose content can
+    be an async iterable of bytes to stream it.
+
+    Modules are reloaded when their file changes, checking at most every
+    `reload_interval` seconds; set it to null to turn reloading off.
+    """
+
+    def __init__(self, app=None, root=None, callable="app", reload_interval=1.0):
+        if (app is None) == (root is None):
+            raise ValueError("app resource needs exactly one of app or root")
+
+        self.log = logging.getLogger("amethyst.app.AppResource")
+
+        self.root = root
+        self.callable = callable
+        self.reload_interval = reload_interval
+
+        self.mounted: Optional[AppModule] = None
+        self.modules: Dict[str, AppModule] = {}
+        self.loading: Dict[str, threading.Lock] = {}
+
+        if app is not None:
+            module, _, attr = app.partition(":")
+            self.mounted = AppModule(module, attr or callable, None, reload_interval)
+
+    def _find(self, ctx: Context) -> Optional[Tuple[AppModule, str]]:
+        if self.mounted is not None:
+            return self.mounted, ctx.path
+
+        name, _, rest = ctx.path.partition("/")
+        name = name or "index"
+
+        if not name.isidentifier():
+            return None
+
+        if (module := self.modules.get(name)) is None:
+            path = os.path.join(self.root, f"{name}.py")
+            if not os.path.isfile(path):
+                return None
+
+            # Checked again under a lock for this name, so that requests
+            # arriving at once for a module not yet loaded only load it the
+            # once, without holding up requests for the others.
+            with self.loading.setdefault(name, threading.Lock()):
+                if (module := self.modules.get(name)) is None:
+                    module = AppModule(
+                        f"amethyst_app_{id(self):x}_{name}",
+                        self.callable,
+                        path,
+                        self.reload_interval,
+                    )
+                    self.modules[name] = module
+
+        return module, rest
+
+    def _load(self, ctx: Context) -> Optional[Tuple[Resource, str]]:
+        # Runs on the executor: finding the module stats files, and
+        # (re)loading it runs whatever code it has at the top level.
+        found = self._find(ctx)
+        if found is None:
+            return None
+
+        module, path = found
+        return module.get(), path
+
+    async def __call__(self, ctx: Context) -> Response:
+        loop = asyncio.get_running_loop()
+
+        try:
+            found = await loop.run_in_executor(
+                ctx.conn.server.executor, self._load, ctx
+            )
+            if found is None:
+                return Response(Status.NOT_FOUND, "Not found")
+
+            app, path = found
+
+        except Exception:
+            self.log.exception(f"Failed to load application for {ctx.orig_path}")
+            return Response(Status.CGI_ERROR, "Application failed to load (see logs)")
+
+        if path != ctx.path:
+            ctx = dataclasses.replace(ctx, path=path)
+
+        try:
+            return await app(ctx)
+        except Exception:
+            self.log.exception(f"Application failed handling {ctx.orig_path}")
+            return Response(Status.CGI_ERROR, "Application error (see logs)")
@@ -0,0 +1 @@
+"""Benchmarks for amethyst, runnable with `python -m amethyst.bench.<name>`."""
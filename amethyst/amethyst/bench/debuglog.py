@@ -0,0 +1,76 @@
+"""Measures what debug logging costs FilesystemResource per request.
+
+Requests are handled (synchronously, without a server) with debug logging
+off and then on, the latter going to a handler which discards everything,
+so the difference is the cost of formatting messages nobody reads.
+
+    python -m amethyst.bench.debuglog [--requests N]
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from ..request import Connection, Context
+from ..resource import FilesystemResource
+from ..response import FileBody, Response
+
+PATHS = ["", "index.gmi", "docs/", "docs/a.gmi", "docs/b.txt", "missing"]
+
+
+def make_tree(root: str):
+    os.makedirs(os.path.join(root, "docs"))
+
+    with open(os.path.join(root, "index.gmi"), "w") as f:
+        f.write("# Hello\n")
+
+    for name in ("a.gmi", "b.txt"):
+        with open(os.path.join(root, "docs", name), "w") as f:
+            f.write("Some text\n" * 10)
+
+    with open(os.path.join(root, "docs", ".meta"), "w") as f:
+        f.write("[.]\nautoindex = true\n")
+
+
+def run(resource: FilesystemResource, requests: int) -> float:
+    conn = Connection(None, "127.0.0.1")  # type: ignore[arg-type]
+    contexts = [Context("localhost", f"/{p}", p, None, conn) for p in PATHS]
+
+    start = time.perf_counter()
+    for i in range(requests):
+        response = resource._handle(contexts[i % len(contexts)])
+        if isinstance(response, Response) and isinstance(response.content, FileBody):
+            response.content.close()
+
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50000)
+    args = parser.parse_args()
+
+    log = logging.getLogger("amethyst")
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root)
+        resource = FilesystemResource(root, cache_size=1048576)
+
+        results = {}
+        for level in (logging.INFO, logging.DEBUG):
+            log.setLevel(level)
+            run(resource, args.requests // 10)
+            results[level] = run(resource, args.requests)
+
+            print(f"{logging.getLevelName(level)}: {results[level]:.0f} requests/s")
+
+    overhead = results[logging.INFO] / results[logging.DEBUG] - 1
+    print(f"Requests take {overhead:.0%} longer with debug logging on")
+
+
+if __name__ == "__main__":
+    main()
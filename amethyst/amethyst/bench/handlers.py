@@ -0,0 +1,281 @@
+"""Benchmarks handlers and resources on their own, without TLS or sockets.
+
+Contexts and connections are built directly and handed to GenericHandler,
+FilesystemResource and (when amethyst_ext is installed) RedirectResource
+and PydocResource in a tight loop, over a synthetic directory tree. Each
+benchmark reports operations per second, memory retained per operation
+and peak memory use; --profile adds the hottest functions according to
+cProfile. Blocking work is done inline rather than on a thread pool,
+unless --threads is given.
+
+    python -m amethyst.bench.handlers [--iterations N] [--threads] [--profile]
+        [--json] [benchmark ...]
+"""
+
+import argparse
+import asyncio
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from ..handler import GenericHandler
+from ..request import Connection, Context
+from ..resource import FilesystemResource, Resource
+from ..response import FileBody, Response, Status
+
+try:
+    from amethyst_ext.pydoc import PydocResource  # type: ignore
+    from amethyst_ext.redirect import RedirectResource  # type: ignore
+except ImportError:
+    PydocResource = RedirectResource = None  # type: ignore
+
+
+Operation = Callable[[], Awaitable[Response]]
+
+
+class Benchmark(NamedTuple):
+    operation: Operation
+
+    # Relative to --iterations, for benchmarks much slower than the rest.
+    scale: float = 1.0
+
+
+def make_tree(root: str, depth: int, width: int):
+    # A directory per level, each with `width` files and a .meta file, so
+    # that looking up metadata deep down has several files to merge.
+    directory = root
+
+    for level in range(depth + 1):
+        for i in range(width):
+            with open(os.path.join(directory, f"file-{i:03}.gmi"), "w") as f:
+                f.write(f"# Level {level}, file {i}\n" + "Some text.\n" * 32)
+
+        with open(os.path.join(directory, ".meta"), "w") as f:
+            f.write("[.]\nautoindex = true\n")
+            f.write("[file-000.gmi]\nmime = text/gemini; lang=en\n")
+
+        directory = os.path.join(directory, f"level-{level + 1}")
+        os.mkdir(directory)
+
+
+class InlineExecutor(Executor):
+    # Runs blocking work right away, on the event loop's thread, so that it
+    # shows up in profiles and thread hand-offs don't dominate timings.
+    def submit(self, fn, /, *args, **kwargs):
+        future: Future = Future()
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+        return future
+
+
+async def constant(ctx: Context) -> Response:
+    return Response(Status.SUCCESS, "text/gemini", b"Hi\n")
+
+
+def make_benchmarks(root: str, depth: int, threads: bool) -> Dict[str, Benchmark]:
+    # Just enough of a Server for resources: an executor and a port.
+    server = SimpleNamespace(
+        executor=ThreadPoolExecutor(thread_name_prefix="amethyst-io")
+        if threads
+        else InlineExecutor(),
+        config=SimpleNamespace(port=1965),
+    )
+    conn = Connection(server, ("127.0.0.1", 12345))  # type: ignore[arg-type]
+
+    deep = "/".join(f"level-{i}" for i in range(1, depth + 1))
+
+    uncached = FilesystemResource(root)
+    cached = FilesystemResource(root, cache_size=16 * 1024 * 1024)
+
+    def resource_op(resource: Resource, path: str, query=None) -> Operation:
+        ctx = Context("localhost", f"/{path}", path, query, conn)
+        return lambda: resource(ctx)
+
+    # Several hosts with a few mounts each, so routing has some work to do.
+    url_map: Dict[str, Dict[str, Resource]] = {
+        f"host{i}.example": {
+            "/": constant,
+            "/static": uncached,
+            "/a/b/c": constant,
+            "/docs": constant,
+        }
+        for i in range(8)
+    }
+    url_map["localhost"] = {"/": cached, "/x/y/z": constant, "/files": cached}
+    handler = GenericHandler(url_map)
+
+    def handler_op(url: str) -> Operation:
+        return lambda: handler(url, conn)
+
+    benchmarks = {
+        "handler-routing": Benchmark(handler_op("gemini://host3.example/a/b/c/d/e?q")),
+        "handler-not-found": Benchmark(handler_op("gemini://elsewhere.example/")),
+        "handler-filesystem": Benchmark(
+            handler_op(f"gemini://localhost/{deep}/file-001.gmi")
+        ),
+        "filesystem-file": Benchmark(resource_op(uncached, "file-001.gmi")),
+        "filesystem-deep-file": Benchmark(
+            resource_op(uncached, f"{deep}/file-001.gmi")
+        ),
+        "filesystem-cached": Benchmark(resource_op(cached, f"{deep}/file-001.gmi")),
+        # file-000.gmi has its MIME type set in .meta.
+        "filesystem-meta-mime": Benchmark(resource_op(cached, f"{deep}/file-000.gmi")),
+        "filesystem-autoindex": Benchmark(resource_op(cached, f"{deep}/")),
+        "filesystem-missing": Benchmark(resource_op(cached, f"{deep}/missing.gmi")),
+    }
+
+    if RedirectResource is not None:
+        redirect = RedirectResource("gemini://example.com/")
+        benchmarks["redirect"] = Benchmark(resource_op(redirect, "some/path"))
+
+    if PydocResource is not None:
+        pydoc = PydocResource()
+        benchmarks["pydoc-module"] = Benchmark(resource_op(pydoc, "json"), 0.05)
+
+    return benchmarks
+
+
+async def run(operation: Operation, iterations: int):
+    for _ in range(iterations):
+        response = await operation()
+
+        if isinstance(response.content, FileBody):
+            response.content.close()
+
+
+class Result(NamedTuple):
+    ops_per_second: float
+    bytes_per_op: float
+    blocks_per_op: float
+    # Beyond what was allocated beforehand.
+    peak_bytes: int
+    profile: Optional[str]
+
+
+def measure(
+    loop: asyncio.AbstractEventLoop,
+    operation: Operation,
+    iterations: int,
+    profile: bool,
+    top: int,
+) -> Result:
+    loop.run_until_complete(run(operation, max(1, iterations // 10)))
+
+    start = time.perf_counter()
+    loop.run_until_complete(run(operation, iterations))
+    ops_per_second = iterations / (time.perf_counter() - start)
+
+    # Memory is traced separately, since tracing slows everything down.
+    # Snapshots only show what's still allocated at the end (caches filling
+    # up, or leaks), so transient allocations show up in the peak instead.
+    traced = max(1, iterations // 10)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    baseline, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+
+    loop.run_until_complete(run(operation, traced))
+
+    _current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    diff = after.compare_to(before, "filename")
+    retained = sum(stat.size_diff for stat in diff)
+    blocks = sum(stat.count_diff for stat in diff)
+
+    report = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        loop.run_until_complete(run(operation, iterations))
+        profiler.disable()
+
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats("tottime").print_stats(top)
+        report = out.getvalue()
+
+    return Result(
+        ops_per_second, retained / traced, blocks / traced, peak - baseline, report
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmarks", nargs="*")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--width", type=int, default=50)
+    parser.add_argument(
+        "--threads",
+        action="store_true",
+        help="do blocking work on a thread pool, like the server does",
+    )
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--top", type=int, default=15, help="functions to profile")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    # Warnings about unknown hosts and missing files would drown the results.
+    logging.getLogger("amethyst").setLevel(logging.ERROR)
+
+    if RedirectResource is None:
+        print("amethyst_ext not installed; skipping its resources", file=sys.stderr)
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.depth, args.width)
+        benchmarks = make_benchmarks(root, args.depth, args.threads)
+
+        names: List[str] = args.benchmarks or list(benchmarks)
+        for name in names:
+            if name not in benchmarks:
+                parser.error(f"unknown benchmark {name!r}")
+
+        loop = asyncio.new_event_loop()
+
+        for name in names:
+            benchmark = benchmarks[name]
+            iterations = max(1, int(args.iterations * benchmark.scale))
+
+            result = results[name] = measure(
+                loop, benchmark.operation, iterations, args.profile, args.top
+            )
+
+            if not args.json:
+                print(
+                    f"{name:>22}: {result.ops_per_second:10.0f} ops/s"
+                    f"  {result.bytes_per_op:8.0f} B/op retained"
+                    f"  {result.blocks_per_op:6.1f} blocks/op"
+                    f"  peak {result.peak_bytes / 1024:8.1f} KiB"
+                )
+
+                if result.profile is not None:
+                    print(result.profile)
+
+        loop.close()
+
+    if args.json:
+        json.dump({name: r._asdict() for name, r in results.items()}, sys.stdout)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""Load tests a local server over TLS, one scenario at a time.
+
+A server is started in a child process on a scratch directory, with a
+generated self-signed certificate, and each scenario has its client
+processes fetch one kind of resource over many concurrent connections.
+Results are printed as a table, and written as JSON so that they can be
+compared between releases.
+
+    python -m amethyst.bench.load [--concurrency N] [--requests N]
+        [--output results.json] [scenario ...]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import socket
+import ssl
+import stat
+import sys
+import tempfile
+import time
+
+from typing import Dict, List, NamedTuple, Tuple
+
+from ..config import Config
+from ..mime import init_mime_types
+from ..resource_registry import registry
+from ..server import Server
+
+
+class Scenario(NamedTuple):
+    path: str
+    status: str
+
+
+SCENARIOS = {
+    "small": Scenario("/small.gmi", "20"),
+    "large": Scenario("/large.bin", "20"),
+    "autoindex": Scenario("/listing/", "20"),
+    "cgi": Scenario("/cgi/hello.sh", "20"),
+    "redirect": Scenario("/redirect", "30"),
+}
+
+
+def make_tree(root: str, large_size: int, listing_size: int):
+    with open(os.path.join(root, "small.gmi"), "w") as f:
+        f.write("# Small\n\n" + "A line of text.\n" * 64)
+
+    with open(os.path.join(root, "large.bin"), "wb") as f:
+        f.write(os.urandom(large_size))
+
+    listing = os.path.join(root, "listing")
+    os.mkdir(listing)
+    for i in range(listing_size):
+        open(os.path.join(listing, f"file-{i:04}.gmi"), "w").close()
+
+    with open(os.path.join(listing, ".meta"), "w") as f:
+        f.write("[.]\nautoindex = true\n")
+
+    cgi = os.path.join(root, "cgi")
+    os.mkdir(cgi)
+
+    script = os.path.join(cgi, "hello.sh")
+    with open(script, "w") as f:
+        f.write("#!/bin/sh\necho 'Content-Type: text/gemini'\necho\necho Hello\n")
+    os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+
+    with open(os.path.join(cgi, ".meta"), "w") as f:
+        f.write("[hello.sh]\ncgi = true\n")
+
+
+def serve(cfg, sock):
+    logging.basicConfig(level=logging.WARNING)
+    init_mime_types()
+
+    config = Config.from_config(cfg)
+    config.load_contexts()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    server = Server(config, [sock])
+    loop.run_until_complete(server.server)
+    loop.run_forever()
+
+
+def percentile(latencies: List[float], p: float) -> float:
+    # Nearest-rank, on an already sorted list.
+    if not latencies:
+        return float("nan")
+
+    rank = max(0, min(len(latencies) - 1, round(p / 100 * len(latencies)) - 1))
+    return latencies[rank]
+
+
+class ClientResult:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.bytes = 0
+
+
+async def fetch(
+    url: bytes, port: int, ssl_context: ssl.SSLContext
+) -> Tuple[bytes, int]:
+    # Returns the response header, and the size of the whole response.
+    reader, writer = await asyncio.open_connection(
+        "127.0.0.1", port, ssl=ssl_context, server_hostname="localhost"
+    )
+
+    try:
+        writer.write(url)
+        header = await reader.readuntil(b"\r\n")
+
+        received = len(header)
+        while chunk := await reader.read(65536):
+            received += len(chunk)
+
+        return header, received
+
+    finally:
+        writer.close()
+
+
+def client_context() -> ssl.SSLContext:
+    c = ssl.create_default_context()
+    c.check_hostname = False
+    c.verify_mode = ssl.CERT_NONE
+    return c
+
+
+async def run_client(
+    port: int, scenario: Scenario, requests: int, concurrency: int
+) -> ClientResult:
+    ssl_context = client_context()
+    url = f"gemini://localhost{scenario.path}\r\n".encode()
+    expected = scenario.status.encode()
+
+    result = ClientResult()
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+
+            try:
+                header, received = await fetch(url, port, ssl_context)
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                result.errors += 1
+                continue
+
+            if not header.startswith(expected):
+                result.errors += 1
+                continue
+
+            result.latencies.append(time.perf_counter() - start)
+            result.bytes += received
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return result
+
+
+def client_process(args: Tuple[int, Scenario, int, int]) -> ClientResult:
+    return asyncio.run(run_client(*args))
+
+
+def wait_for_server(port: int, server, timeout: float = 60):
+    # The server generates its certificate before it starts listening.
+    deadline = time.monotonic() + timeout
+    url = b"gemini://localhost/\r\n"
+
+    while True:
+        try:
+            asyncio.run(fetch(url, port, client_context()))
+            return
+        except (OSError, asyncio.IncompleteReadError):
+            if not server.is_alive():
+                raise RuntimeError("Server exited before it was ready") from None
+
+            if time.monotonic() > deadline:
+                raise
+
+            time.sleep(0.1)
+
+
+def run_scenario(
+    pool, port: int, scenario: Scenario, requests: int, concurrency: int, processes: int
+) -> Dict[str, float]:
+    jobs = [
+        (port, scenario, requests // processes, max(1, concurrency // processes))
+        for _ in range(processes)
+    ]
+
+    start = time.perf_counter()
+    results = pool.map(client_process, jobs)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(l for r in results for l in r.latencies)
+    return {
+        "requests": len(latencies),
+        "errors": sum(r.errors for r in results),
+        "seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed,
+        "bytes_per_second": sum(r.bytes for r in results) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--large-size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--listing-size", type=int, default=200)
+    parser.add_argument("--key-type", default="ecdsa")
+    parser.add_argument("--output", help="file to write JSON results to")
+    args = parser.parse_args()
+    has_redirect = "redirect" in registry
+
+    # Redirects come from amethyst_ext, which might not be installed.
+    available = [name for name in SCENARIOS if name != "redirect" or has_redirect]
+    if not has_redirect:
+        print("amethyst_ext not installed; skipping redirects", file=sys.stderr)
+
+    scenarios = args.scenarios or available
+    for name in scenarios:
+        if name not in available:
+            parser.error(f"unknown or unavailable scenario {name!r}")
+
+    with tempfile.TemporaryDirectory() as scratch:
+        root = os.path.join(scratch, "root")
+        os.mkdir(root)
+        make_tree(root, args.large_size, args.listing_size)
+
+        sock = socket.create_server(("127.0.0.1", 0), backlog=1024)
+        port = sock.getsockname()[1]
+
+        # Certificates are generated in the state directory.
+        os.environ["STATE_DIRECTORY"] = scratch
+
+        cfg = {
+            "port": port,
+            "access_log": {"path": os.path.join(scratch, "access.log")},
+            "hosts": [
+                {
+                    "name": "localhost",
+                    "tls": {"key_type": args.key_type},
+                    "paths": {
+                        "/": {"root": root, "cgi": True, "cache_size": 1048576},
+                    },
+                }
+            ],
+        }
+
+        if has_redirect:
+            cfg["hosts"][0]["paths"]["/redirect"] = {
+                "type": "redirect",
+                "to": "gemini://localhost/",
+            }
+
+        context = multiprocessing.get_context("fork")
+        server = context.Process(target=serve, args=(cfg, sock), daemon=True)
+        server.start()
+        sock.close()
+
+        try:
+            results = {}
+            wait_for_server(port, server)
+
+            with context.Pool(args.processes) as pool:
+                for name in scenarios:
+                    results[name] = run_scenario(
+                        pool,
+                        port,
+                        SCENARIOS[name],
+                        args.requests,
+                        args.concurrency,
+                        args.processes,
+                    )
+
+                    r = results[name]
+                    print(
+                        f"{name:>10}: {r['requests_per_second']:9.1f} req/s"
+                        f"  p50 {r['p50_ms']:8.2f} ms  p99 {r['p99_ms']:8.2f} ms"
+                        f"  {r['errors']} errors",
+                        file=sys.stderr,
+                    )
+
+        finally:
+            server.terminate()
+            server.join()
+
+    output = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "processes": args.processes,
+            "large_size": args.large_size,
+            "listing_size": args.listing_size,
+            "key_type": args.key_type,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
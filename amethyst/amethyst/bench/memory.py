@@ -0,0 +1,94 @@
+"""Measures the memory each request in flight holds in request objects.
+
+Many requests' worth of Connection, Context and Response objects are kept
+alive at once, and tracemalloc tells how much memory they take between
+them. For comparison, the same is done with plain dataclasses laid out
+the way these classes used to be.
+
+    python -m amethyst.bench.memory [--requests N]
+"""
+
+import argparse
+import tracemalloc
+
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from ..request import Connection, Context
+from ..response import Response, Status
+
+
+@dataclass
+class DataclassConnection:
+    server: Any
+    peer_addr: Any
+    peer_cert: Optional[bytes] = None
+    host: Optional[str] = None
+
+
+@dataclass
+class DataclassContext:
+    host: str
+    orig_path: str
+    path: str
+    query: Optional[str]
+    conn: Any
+
+    data: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class DataclassResponse:
+    status_code: Status
+    meta: str
+    content: Optional[Any] = None
+
+
+def measure(make: Callable[[int], Any], requests: int) -> float:
+    # Strings are shared between requests, so that only the objects
+    # themselves are counted.
+    tracemalloc.start()
+    before, _peak = tracemalloc.get_traced_memory()
+
+    alive: List[Any] = [make(i) for i in range(requests)]
+
+    after, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del alive
+    return (after - before) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100000)
+    args = parser.parse_args()
+
+    server = object()
+    peer = ("127.0.0.1", 54321)
+    body = b"# Hello\n"
+
+    def slotted(i):
+        conn = Connection(server, peer)
+        ctx = Context("localhost", "/index.gmi", "index.gmi", None, conn)
+        return ctx, Response(Status.SUCCESS, "text/gemini", body)
+
+    def dataclasses(i):
+        conn = DataclassConnection(server, peer)
+        ctx = DataclassContext("localhost", "/index.gmi", "index.gmi", None, conn)
+        return ctx, DataclassResponse(Status.SUCCESS, "text/gemini", body)
+
+    results = {
+        "dataclasses": measure(dataclasses, args.requests),
+        "slots": measure(slotted, args.requests),
+    }
+
+    for name, per_request in results.items():
+        print(f"{name:>12}: {per_request:6.0f} bytes per request")
+
+    saved = 1 - results["slots"] / results["dataclasses"]
+    print(f"Slotted request objects use {saved:.0%} less memory")
+
+
+if __name__ == "__main__":
+    main()
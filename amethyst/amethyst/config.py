@@ -1,15 +1,21 @@
+import asyncio
 import datetime
+import fcntl
+import logging
 import ssl
 
-from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
 
 from .handler import GenericHandler, Handler
+from .ratelimit import RateLimiter
 from .resource import Resource
 from .resource_registry import registry
 
 import os
 
+log = logging.getLogger("amethyst.config")
+
 
 @dataclass
 class TLSConfig:
@@ -18,15 +24,39 @@ class TLSConfig:
     cert_path: Optional[str] = None
     key_path: Optional[str] = None
 
-    _context_cache: Optional[Tuple[datetime.datetime, ssl.SSLContext]] = None
+    # Type of key to generate for cert_path/key_path, when there isn't one
+    # already: "rsa", "ecdsa" (P-256) or "ed25519".
+    key_type: str = "rsa"
+
+    # More (key type, cert path, key path) chains served from the same
+    # context, e.g. an RSA chain for clients which can't do ECDSA. These are
+    # generated (and renewed) like the main one, when auto is on.
+    key_type_chains: List[Tuple[str, str, str]] = field(default_factory=list)
+
+    # (cert path, key path) chains managed by someone else, which are only
+    # ever loaded, whether or not auto is on.
+    extra_chains: List[Tuple[str, str]] = field(default_factory=list)
+
+    # Automatic certificates are renewed this long before they expire.
+    renew_before: datetime.timedelta = datetime.timedelta(days=7)
+
+    # When the (first to expire) certificate we're serving expires.
+    not_valid_after: Optional[datetime.datetime] = None
+
+    _context_cache: Optional[Tuple[Optional[datetime.datetime], ssl.SSLContext]] = None
+    _context_files: Optional[Tuple[Optional[int], ...]] = None
+    _loading: Optional[asyncio.Future] = None
 
     @classmethod
     def from_config(cls, host, cfg):
+        from . import tls
+
         o = cls(host)
 
         state = os.getenv("STATE_DIRECTORY", ".")
 
         o.auto = cfg.get("auto", True)
+        o.renew_before = datetime.timedelta(days=cfg.get("renew_before_days", 7))
 
         o.cert_path = cfg.get("cert_path", None)
         if o.cert_path is None:
@@ -36,31 +66,169 @@ class TLSConfig:
         if o.key_path is None:
             o.key_path = os.path.join(state, f"{host}.key.pem")
 
+        # Either one key type, or a list of them to serve a chain for each;
+        # the chains after the first get their own files.
+        key_types = cfg.get("key_type", "rsa")
+        if isinstance(key_types, str):
+            key_types = [key_types]
+
+        for key_type in key_types:
+            if key_type not in tls.KEY_TYPES:
+                raise ValueError(f"Unknown key type {key_type!r} for {host}")
+
+        o.key_type = key_types[0]
+
+        for key_type in key_types[1:]:
+            o.key_type_chains.append(
+                (
+                    key_type,
+                    os.path.join(state, f"{host}.{key_type}.cert.pem"),
+                    os.path.join(state, f"{host}.{key_type}.key.pem"),
+                )
+            )
+
+        for chain in cfg.get("extra_chains", []):
+            o.extra_chains.append((chain["cert_path"], chain["key_path"]))
+
         return o
 
-    def clear_context_cache(self):
-        self._context_cache = None
+    def get_ssl_context(self) -> Optional[ssl.SSLContext]:
+        # This runs in the middle of handshakes, so it never touches
+        # certificates itself; an expired (or missing) context gets rebuilt
+        # in the background, and the old one is used until that's done.
+        if self._context_cache is None:
+            self.schedule_load()
+            return None
+
+        expires, context = self._context_cache
+        if expires is not None and expires <= datetime.datetime.now():
+            self.schedule_load()
+
+        return context
+
+    def schedule_load(self):
+        if self._loading is not None and not self._loading.done():
+            return
+
+        loop = asyncio.get_event_loop()
+        self._loading = loop.run_in_executor(None, self.load_context)
+        self._loading.add_done_callback(self._loaded)
+
+    def _loaded(self, future: "asyncio.Future[ssl.SSLContext]"):
+        if not future.cancelled() and future.exception() is not None:
+            log.error(
+                f"Failed to load TLS context for {self.host}",
+                exc_info=future.exception(),
+            )
+
+    def _settings(self):
+        return (
+            self.auto,
+            self.cert_path,
+            self.key_path,
+            self.key_type,
+            self.key_type_chains,
+            self.extra_chains,
+            self.renew_before,
+        )
+
+    def _files(self) -> Tuple[Optional[int], ...]:
+        # Modification times of our certificates and keys, to notice when
+        # they're replaced from outside.
+        paths = [self.cert_path, self.key_path]
+        for cert_path, key_path in self._chains():
+            paths += [cert_path, key_path]
+
+        mtimes: List[Optional[int]] = []
+        for path in paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns if path else None)
+            except OSError:
+                mtimes.append(None)
+
+        return tuple(mtimes)
+
+    def reuse_context(self, other: "TLSConfig") -> bool:
+        # Takes over other's context, if it's for the same settings and
+        # none of its files have changed since it was loaded.
+        if (
+            other._context_cache is None
+            or other._settings() != self._settings()
+            or other._context_files != self._files()
+        ):
+            return False
 
-    def get_ssl_context(self):
+        self._context_cache = other._context_cache
+        self._context_files = other._context_files
+        self.not_valid_after = other.not_valid_after
+        return True
+
+    def _chains(self) -> List[Tuple[str, str]]:
+        # Every chain besides the main one, generated or not.
+        generated = [(cert, key) for _, cert, key in self.key_type_chains]
+        return generated + self.extra_chains
+
+    def renew_at(self) -> Optional[datetime.datetime]:
+        if not self.auto or self.not_valid_after is None:
+            return None
+
+        return self.not_valid_after - self.renew_before
+
+    def load_context(self) -> ssl.SSLContext:
         from . import tls
 
-        if self._context_cache is not None:
-            expires, context = self._context_cache
+        assert self.cert_path is not None and self.key_path is not None
 
-            if expires is None or expires > datetime.datetime.now():
-                return context
+        expires: Optional[datetime.datetime]
 
         if self.auto:
-            expires = tls.update_certificate(self.cert_path, self.key_path, [self.host])
+            # Every worker renews its own contexts, but only one of them
+            # should write new certificates; the rest pick those up.
+            with open(f"{self.cert_path}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                expires = tls.update_certificate(
+                    self.cert_path,
+                    self.key_path,
+                    [self.host],
+                    self.key_type,
+                    self.renew_before,
+                )
+
+                for key_type, cert_path, key_path in self.key_type_chains:
+                    expires = min(
+                        expires,
+                        tls.update_certificate(
+                            cert_path,
+                            key_path,
+                            [self.host],
+                            key_type,
+                            self.renew_before,
+                        ),
+                    )
+
+                context = tls.make_context(
+                    self.cert_path, self.key_path, self._chains()
+                )
+
+            self.not_valid_after = expires
 
         else:
             # We want to keep using a manually-specified certificate forever
             # or at least until the server is restarted / HUPed.
             expires = None
 
-        context = tls.make_context(self.cert_path, self.key_path)
+            context = tls.make_context(self.cert_path, self.key_path, self._chains())
+
+            self.not_valid_after = min(
+                tls.read_expiry(path)
+                for path in [self.cert_path] + [c for c, _ in self._chains()]
+            )
 
+        # Handshakes in progress keep whichever context they got; this swaps
+        # in the new one for everything after.
         self._context_cache = expires, context
+        self._context_files = self._files()
         return context
 
 
@@ -69,6 +237,7 @@ class HostConfig:
     host: str
     tls: TLSConfig
     path_map: Dict[str, Resource]
+    rate_limit: Optional[RateLimiter] = None
 
     @classmethod
     def _construct_resource(cls, cfg) -> Resource:
@@ -84,7 +253,11 @@ class HostConfig:
             for path, config in cfg["paths"].items()
         }
 
-        return cls(host, tls, path_map)
+        rate_limit = None
+        if "rate_limit" in cfg:
+            rate_limit = RateLimiter.from_config(cfg["rate_limit"])
+
+        return cls(host, tls, path_map, rate_limit)
 
 
 @dataclass
@@ -93,16 +266,107 @@ class Config:
     handler: Handler
     port: int = 1965
 
+    # Size of the thread pool used for blocking (disk) I/O; None lets
+    # concurrent.futures pick a default based on the CPU count.
+    io_threads: Optional[int] = None
+
+    # Number of server processes to run. With reuse_port, each worker binds
+    # its own SO_REUSEPORT socket; otherwise they share sockets bound up front.
+    workers: int = 1
+    reuse_port: bool = False
+
+    # Connections beyond this many at once are answered with SLOW_DOWN
+    max_connections: Optional[int] = None
+
+    # Seconds allowed for the TLS handshake, for the client to send its
+    # request line, and for the whole response to be written back.
+    handshake_timeout: Optional[float] = 10
+    request_timeout: Optional[float] = 10
+    response_timeout: Optional[float] = 600
+
+    # TLS 1.3 session tickets to issue per handshake; 0 turns tickets off.
+    # Gemini clients make a new connection per request, and each resumption
+    # gets fresh tickets, so one is usually enough.
+    session_tickets: int = 1
+
+    # On SIGTERM or SIGINT, seconds to let connections in progress finish
+    # before exiting; None waits for as long as they take.
+    drain_timeout: Optional[float] = 30
+
+    # Where to serve metrics over HTTP, if at all: host:port (the host
+    # defaulting to localhost) or the path of a Unix socket. In multi-worker
+    # mode, each worker offsets the port (or suffixes the path) by its index.
+    metrics_address: Optional[str] = None
+
+    # Access log settings (path, format: "combined" or "json", buffer_size);
+    # see AccessLog. Without a path, entries go to the amethyst.access logger.
+    access_log: Dict[str, Any] = field(default_factory=dict)
+
+    # Level for the server's logging, e.g. "DEBUG" or "WARNING".
+    log_level: str = "INFO"
+
+    # Hosts by name, for looking them up during handshakes.
+    hosts_by_name: Dict[str, HostConfig] = field(default_factory=dict)
+
     def load(self, cfg):
         self.hosts = [HostConfig.from_config(host) for host in cfg.get("hosts", [])]
 
         if not self.hosts:
             raise ValueError("Server can't run without any hosts!")
 
-        self.handler = GenericHandler({host.host: host.path_map for host in self.hosts})
+        self.hosts_by_name = {host.host: host for host in self.hosts}
+
+        self.handler = GenericHandler(
+            {host.host: host.path_map for host in self.hosts},
+            {host.host: host.rate_limit for host in self.hosts if host.rate_limit},
+        )
+
+    def load_contexts(self, previous: Optional["Config"] = None):
+        # Builds every host's TLS context (creating or renewing certificates
+        # as needed) up front, so that handshakes never have to. Contexts
+        # which haven't changed since the previous configuration are reused.
+        for host in self.hosts:
+            if previous is not None:
+                old = previous.hosts_by_name.get(host.host)
+                if old is not None and host.tls.reuse_context(old.tls):
+                    continue
+
+            try:
+                host.tls.load_context()
+            except Exception:
+                log.exception(f"Failed to load TLS context for {host.host}")
+
+    async def close(self):
+        # Lets resources release whatever they hold (processes, sockets,
+        # ...) once this configuration is no longer in use. Resources which
+        # need to do that have an async close() method.
+        for host in self.hosts:
+            for resource in host.path_map.values():
+                close = getattr(resource, "close", None)
+                if close is not None:
+                    try:
+                        await close()
+                    except Exception:
+                        log.exception(f"Failed to close {resource!r}")
 
     @classmethod
     def from_config(cls, cfg):
-        o = cls([], None, cfg.get("port", 1965))
+        o = cls(
+            [],
+            None,
+            cfg.get("port", 1965),
+            cfg.get("io_threads"),
+            cfg.get("workers", 1),
+            cfg.get("reuse_port", False),
+            cfg.get("max_connections"),
+            cfg.get("handshake_timeout", 10),
+            cfg.get("request_timeout", 10),
+            cfg.get("response_timeout", 600),
+            cfg.get("session_tickets", 1),
+            cfg.get("drain_timeout", 30),
+            cfg.get("metrics_address"),
+            cfg.get("access_log", {}),
+            cfg.get("log_level", "INFO"),
+        )
         o.load(cfg)
         return o
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+import signal
+
+from typing import Callable, Dict, Optional, Tuple
+
+from .request import Context
+from .response import CGITimeoutError, Status
+
+CHUNK_SIZE = 65536
+STDERR_LIMIT = 65536
+
+
+def cgi_environ(ctx: Context, script_name: str, path_info: str) -> Dict[str, str]:
+    # TODO: signal client certificates here
+    return {
+        "GATEWAY_INTERFACE": "CGI/1.1",
+        "QUERY_STRING": ctx.query or "",
+        "REMOTE_ADDR": ctx.conn.peer_addr[0],
+        "SCRIPT_NAME": script_name,
+        "PATH_INFO": path_info,
+        "SERVER_NAME": ctx.host,
+        "SERVER_PORT": str(ctx.conn.server.config.port),
+        "SERVER_PROTOCOL": "Gemini/0.16.0",
+        "SERVER_SOFTWARE": "Amethyst",
+    }
+
+
+async def read_cgi_headers(
+    reader: asyncio.StreamReader, allow_empty: bool = True
+) -> Tuple[Status, str, bytes]:
+    # Reads the header block of CGI-style output, returning the status and
+    # meta to respond with, and any part of the body that got read along
+    # with the headers. Unless allow_empty is set, output that ends before
+    # anything was sent raises IncompleteReadError.
+    content_type = "text/gemini"
+    status = Status.SUCCESS
+    first = True
+
+    while True:
+        line = await reader.readline()
+
+        if not line and first and not allow_empty:
+            raise asyncio.IncompleteReadError(b"", None)
+        first = False
+
+        # Lines may end in either LF or CRLF; SCGI apps tend to use the latter.
+        stripped = line.rstrip(b"\r\n")
+        if not stripped or b":" not in stripped:
+            # Either the blank line ending the headers, or output without
+            # any headers at all (which is part of the body).
+            return status, content_type, line if stripped else b""
+
+        key, value = stripped.decode().strip().split(":", maxsplit=1)
+        key, value = key.strip().lower(), value.strip()
+
+        if key == "content-type":
+            content_type = value
+        elif key == "status":
+            try:
+                status = Status(int(value))
+            except ValueError:
+                pass
+        elif key == "location":
+            return Status.REDIRECT_TEMPORARY, value, b""
+
+
+class CGIOutput:
+    """The output of a running CGI script, as a streamed response body.
+
+    Reading past the script's deadline kills it. Once the output has been
+    read (or the body is closed early), the script is reaped, its exit
+    status and stderr logged, and `on_exit` is called.
+    """
+
+    def __init__(
+        self,
+        proc: asyncio.subprocess.Process,
+        name: str,
+        timeout: Optional[float],
+        log: logging.Logger,
+        on_exit: Callable[[], None],
+    ):
+        assert proc.stdout is not None and proc.stderr is not None
+
+        self.proc = proc
+        self.stdout = proc.stdout
+        self.name = name
+        self.log = log
+        self.on_exit = on_exit
+
+        self.loop = asyncio.get_running_loop()
+        self.deadline = None if timeout is None else self.loop.time() + timeout
+
+        self.stdout_bytes = 0
+        self.stderr = bytearray()
+        self.stderr_bytes = 0
+        self.stderr_task = self.loop.create_task(self._read_stderr(proc.stderr))
+
+        self.killed = False
+        self.returncode: Optional[int] = None
+        self.exit_task: Optional[asyncio.Task] = None
+        self.pending = b""
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+
+        return max(0.0, self.deadline - self.loop.time())
+
+    def at_eof(self) -> bool:
+        return not self.pending and self.stdout.at_eof()
+
+    def kill(self):
+        # Scripts run in their own session, so this takes out anything
+        # they've spawned too.
+        self.killed = True
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    async def _read_stderr(self, stderr: asyncio.StreamReader):
+        while chunk := await stderr.read(CHUNK_SIZE):
+            self.stderr_bytes += len(chunk)
+            if len(self.stderr) < STDERR_LIMIT:
+                self.stderr += chunk[: STDERR_LIMIT - len(self.stderr)]
+
+    async def read_headers(self) -> Tuple[Status, str]:
+        try:
+            status, meta, self.pending = await asyncio.wait_for(
+                read_cgi_headers(self.stdout), self.remaining()
+            )
+        except BaseException:
+            await self.aclose()
+            raise
+
+        return status, meta
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.pending:
+            chunk, self.pending = self.pending, b""
+
+        else:
+            try:
+                chunk = await asyncio.wait_for(
+                    self.stdout.read(CHUNK_SIZE), self.remaining()
+                )
+            except asyncio.TimeoutError:
+                self.log.warning(f"{self.name} timed out; killing it")
+                self.kill()
+                await self.finish()
+                raise CGITimeoutError(self.name, self.stdout_bytes) from None
+
+            if not chunk:
+                await self.finish()
+                raise StopAsyncIteration
+
+        self.stdout_bytes += len(chunk)
+        return chunk
+
+    async def read_ahead(self, limit: int, wait: float) -> bool:
+        # Buffers up to `limit` bytes of the body, giving the script at most
+        # `wait` seconds to produce them, and returns whether that turned out
+        # to be all of it. Only running past the script's own deadline
+        # raises TimeoutError.
+        deadline = self.loop.time() + wait
+        if self.deadline is not None:
+            deadline = min(deadline, self.deadline)
+
+        while len(self.pending) < limit:
+            try:
+                chunk = await asyncio.wait_for(
+                    self.stdout.read(CHUNK_SIZE),
+                    max(0.0, deadline - self.loop.time()),
+                )
+            except asyncio.TimeoutError:
+                if self.remaining() == 0:
+                    raise
+
+                return False
+
+            if not chunk:
+                return True
+
+            self.pending += chunk
+
+        return self.stdout.at_eof()
+
+    async def drain(self):
+        # Discard whatever's left, letting the script run to completion.
+        async for _chunk in self:
+            pass
+
+    async def aclose(self):
+        if self.returncode is None:
+            self.kill()
+            await self.finish()
+
+    async def finish(self):
+        # Reaping happens in its own task, so that it still completes (and
+        # releases our slot) if whoever is waiting for it gets cancelled.
+        if self.exit_task is None:
+            self.exit_task = self.loop.create_task(self._reap())
+
+        await asyncio.shield(self.exit_task)
+
+    async def _reap(self):
+        if not self.killed:
+            try:
+                await asyncio.wait_for(self.proc.wait(), self.remaining())
+            except asyncio.TimeoutError:
+                self.log.warning(f"{self.name} timed out; killing it")
+                self.kill()
+
+        await self.proc.wait()
+
+        await self.stderr_task
+
+        self.returncode = self.proc.returncode
+        self.on_exit()
+
+        self.log.info(
+            f"{self.name} returned {self.returncode} "
+            f"(stdout bytes {self.stdout_bytes}, "
+            f"stderr bytes {self.stderr_bytes})"
+        )
+
+        if self.returncode != 0:
+            self.log.warning("Script stderr:")
+            self.log.warning(bytes(self.stderr))
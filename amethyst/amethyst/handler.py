@@ -1,20 +1,76 @@
+from .ratelimit import RateLimiter
 from .resource import Resource
 from .response import Status, Response
 from .request import Connection, Context
 from .util import get_path_components
 from urllib.parse import urlparse
-from typing import Dict, Callable, Awaitable
+from typing import Dict, Callable, Awaitable, List, Optional, Tuple
 
 import logging
+import math
 import re
 
 Handler = Callable[[str, Connection], Awaitable[Response]]
 PORT_RE = re.compile(r":([0-9]{1,5})$")
 
 
+class RouteNode:
+    __slots__ = ("children", "resource")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "RouteNode"] = {}
+        self.resource: Optional[Resource] = None
+
+    @classmethod
+    def compile(cls, path_map: Dict[str, Resource]) -> "RouteNode":
+        root = cls()
+
+        for path, resource in path_map.items():
+            node = root
+            for component in get_path_components(path):
+                child = node.children.get(component)
+                if child is None:
+                    child = node.children[component] = cls()
+
+                node = child
+
+            # Several mount points can normalize to the same components
+            # ("/a" and "/a/"); the first one configured wins, as before.
+            if node.resource is None:
+                node.resource = resource
+
+        return root
+
+    def lookup(self, components: List[str]) -> Tuple[Optional[Resource], int]:
+        """Return the resource mounted at the longest prefix of components,
+        along with the number of components that prefix consumed."""
+
+        node = self
+        resource, depth = node.resource, 0
+
+        for i, component in enumerate(components, 1):
+            child = node.children.get(component)
+            if child is None:
+                break
+
+            node = child
+            if node.resource is not None:
+                resource, depth = node.resource, i
+
+        return resource, depth
+
+
 class GenericHandler:
-    def __init__(self, url_map: Dict[str, Dict[str, Resource]]):
+    def __init__(
+        self,
+        url_map: Dict[str, Dict[str, Resource]],
+        rate_limits: Optional[Dict[str, RateLimiter]] = None,
+    ):
         self.url_map = url_map
+        self.rate_limits = rate_limits or {}
+        self.routes = {
+            host: RouteNode.compile(path_map) for host, path_map in url_map.items()
+        }
         self.log = logging.getLogger("amethyst.handler.GenericHandler")
 
     async def __call__(self, url: str, conn: Connection) -> Response:
@@ -40,7 +96,8 @@ class GenericHandler:
 
             host = PORT_RE.sub("", host)
 
-        if host not in self.url_map:
+        routes = self.routes.get(host)
+        if routes is None:
             self.log.warn(f"Received request for host {host} not in URL map")
 
             return Response(
@@ -48,19 +105,23 @@ class GenericHandler:
                 f"{host} is not served here.",
             )
 
-        req_path = result.path
+        conn.host = host
+
+        rate_limit = self.rate_limits.get(host)
+        if rate_limit is not None:
+            wait = rate_limit.check(conn.peer_addr[0])
+            if wait:
+                return Response(Status.SLOW_DOWN, str(math.ceil(wait)))
+
         try:
-            req_path = get_path_components(req_path)
+            req_path = get_path_components(result.path)
         except ValueError:
             return Response(Status.BAD_REQUEST, "Invalid URL")
 
-        paths = [(get_path_components(i), v) for i, v in self.url_map[host].items()]
-
-        for path, resource in sorted(paths, key=lambda k: len(k[0]), reverse=True):
-            if len(req_path) < len(path) or req_path[: len(path)] != path:
-                continue
+        resource, depth = routes.lookup(req_path)
 
-            truncated_path = "/".join(req_path[len(path) :])
+        if resource is not None:
+            truncated_path = "/".join(req_path[depth:])
             if result.path.endswith("/"):
                 truncated_path += "/"
 
@@ -1,51 +1,314 @@
 from .config import Config
+from .metrics import Counter, Gauge, start_metrics_server, worker_address
 from .mime import init_mime_types
-from .server import Server
+from .server import Server, bind
+from .tls import make_sni_context
 
 import asyncio
+import datetime
 import json
 import logging
+import os
 import signal
+import socket
+import ssl
 import sys
+import time
+
+from typing import Dict, List, Optional
 
 log = logging.getLogger("amethyst.kindergarten")
 
+# How often to look at certificates, at most, and how soon to try again
+# after failing to renew one.
+RENEWAL_CHECK_INTERVAL = datetime.timedelta(hours=1)
+RENEWAL_RETRY_INTERVAL = datetime.timedelta(minutes=5)
+
 
 class ServerManager:
     def __init__(self, config_path):
         self.config_path = config_path
         self.config = Config.from_config(self._get_config())
-        self.server = Server(self.config)
+        self.server: Optional[Server] = None
+
+        # How long the last reload took, and how many failed.
+        self.reload_seconds: Optional[float] = None
+        self.failed_reloads = 0
+
+        # pid -> worker index, for the supervisor in multi-worker mode
+        self.workers: Dict[int, int] = {}
+        self.stopping = False
+
+        # Configurations replaced by a reload, but not yet closed.
+        self.retired: List[Config] = []
 
     def _get_config(self):
         with open(self.config_path) as f:
             return json.load(f)
 
+    def load_config(self) -> Config:
+        # Builds a complete new configuration, without touching the one in
+        # use; it only takes effect once it's assigned.
+        config = Config.from_config(self._get_config())
+        config.load_contexts(self.config)
+        return config
+
     def reconfigure(self):
         log.info("Received HUP; reloading configuration.")
 
-        self.config.load(self._get_config())
+        start = time.monotonic()
+        try:
+            self.config = self.load_config()
+        except Exception:
+            self.failed_reloads += 1
+            raise
+
+        self.reload_seconds = time.monotonic() - start
+
+    async def reload(self):
+        # Like reconfigure(), but building the new configuration on a thread
+        # while we carry on serving with the old one.
+        log.info("Received HUP; reloading configuration.")
+
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+
+        try:
+            config = await loop.run_in_executor(None, self.load_config)
+        except Exception:
+            self.failed_reloads += 1
+            log.exception("Failed to reload configuration; keeping the old one")
+            return
+
+        old, self.config = self.config, config
+        if self.server is not None:
+            self.server.config = config
+
+            # Lets access logs be rotated by moving them and sending a HUP.
+            self.server.access_log.reopen()
+
+        self.reload_seconds = time.monotonic() - start
+        log.info(f"Reloaded configuration in {self.reload_seconds:.3f}s")
+
+        await self.retire(old)
+
+    async def retire(self, config: Config):
+        # Connections already under way may still be using the old
+        # configuration's resources, so it's only closed once they're done.
+        # If we're shut down first, run() closes it instead.
+        self.retired.append(config)
 
-        for host in self.config.hosts:
-            host.tls.clear_context_cache()
+        if self.server is not None and self.server.tasks:
+            await asyncio.wait(set(self.server.tasks))
+
+        await config.close()
+        self.retired.remove(config)
 
     def start(self):
         # XXX: Not sure a global MIME type configuration is "correct" here.
         # Perhaps Server should be responsible for its own MimeTypes module?
         init_mime_types()
 
+        # Before forking, so that workers all start out with them.
+        self.config.load_contexts()
+
+        if self.config.workers > 1:
+            self.supervise()
+        else:
+            self.run()
+
+    def run(self, sockets=None, ssl_context=None, index=None):
+        server = self.server = Server(self.config, sockets, ssl_context)
+        server.metrics.collector(self.collect_metrics)
+
         loop = asyncio.get_event_loop()
-        loop.add_signal_handler(signal.SIGHUP, self.reconfigure)
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(self.reload()))
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.request_stop)
 
         log.info(f"Starting server on port {self.config.port}")
 
-        loop.run_until_complete(self.server.server)
+        loop.run_until_complete(server.server)
+
+        address = self.config.metrics_address
+        if address is not None:
+            if index is not None:
+                address = worker_address(address, index)
+
+            loop.run_until_complete(start_metrics_server(server.metrics, address))
+
+        loop.create_task(server.watch_loop())
+        loop.create_task(self.renew_certificates())
         loop.run_forever()
 
+        # Wind down whatever's left running (renewals, health checks, ...)
+        # so they get to clean up after themselves.
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+        for config in self.retired:
+            loop.run_until_complete(config.close())
+
+        log.info("Server stopped")
+
+    def collect_metrics(self):
+        failures = Counter(
+            "amethyst_reload_failures_total", "Configuration reloads that failed."
+        )
+        failures.inc(amount=self.failed_reloads)
+        yield failures
+
+        if self.reload_seconds is not None:
+            duration = Gauge(
+                "amethyst_reload_duration_seconds",
+                "Time the last successful configuration reload took.",
+            )
+            duration.set(self.reload_seconds)
+            yield duration
+
+    def request_stop(self):
+        if self.stopping:
+            return
+
+        self.stopping = True
+        asyncio.get_event_loop().create_task(self.stop())
+
+    async def stop(self):
+        log.info("Shutting down; no longer accepting connections")
+
+        assert self.server is not None
+        await self.server.shutdown(self.config.drain_timeout)
+
+        asyncio.get_running_loop().stop()
+
+    async def renew_certificates(self):
+        # Renews automatic certificates ahead of time, on a thread, so that
+        # it never holds up the event loop or a handshake.
+        loop = asyncio.get_running_loop()
+
+        while True:
+            now = datetime.datetime.now()
+            next_check = now + RENEWAL_CHECK_INTERVAL
+
+            for host in self.config.hosts:
+                tls = host.tls
+
+                renew_at = tls.renew_at()
+                if renew_at is not None and renew_at <= now:
+                    log.info(f"Renewing certificate for {host.host}")
+
+                    try:
+                        await loop.run_in_executor(None, tls.load_context)
+                    except Exception:
+                        log.exception(f"Failed to renew certificate for {host.host}")
+                        next_check = min(next_check, now + RENEWAL_RETRY_INTERVAL)
+                        continue
+
+                    renew_at = tls.renew_at()
+
+                if tls.not_valid_after is not None:
+                    log.debug(
+                        f"Certificate for {host.host} expires in "
+                        f"{tls.not_valid_after - now}"
+                    )
+
+                if renew_at is not None:
+                    next_check = min(next_check, max(renew_at, now))
+
+            delay = (next_check - datetime.datetime.now()).total_seconds()
+            await asyncio.sleep(max(delay, RENEWAL_RETRY_INTERVAL.total_seconds()))
+
+    def spawn_worker(
+        self,
+        index: int,
+        sockets: Optional[List[socket.socket]],
+        ssl_context: ssl.SSLContext,
+    ):
+        pid = os.fork()
+
+        if pid:
+            self.workers[pid] = index
+            return
+
+        # In the worker: drop the supervisor's signal handlers and serve
+        # until we're killed. HUP is ignored until run() installs its own
+        # handler, so a reload right now doesn't kill us.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        status = 0
+        try:
+            log.info(f"Worker {index} started (pid {os.getpid()})")
+            self.run(sockets, ssl_context, index)
+        except BaseException:
+            log.exception(f"Worker {index} crashed")
+            status = 1
+        finally:
+            os._exit(status)
+
+    def signal_workers(self, signum, _frame=None):
+        if signum == signal.SIGHUP:
+            # Reload here too, so that workers we restart later come up with
+            # the new configuration.
+            try:
+                self.reconfigure()
+            except Exception:
+                log.exception("Failed to reload configuration in supervisor")
+
+        else:
+            self.stopping = True
+
+        for pid in self.workers:
+            os.kill(pid, signum)
+
+    def supervise(self):
+        # With reuse_port, each worker binds its own socket and the kernel
+        # balances connections between them; otherwise workers accept from
+        # sockets bound once, here.
+        sockets = None if self.config.reuse_port else bind(self.config.port)
+
+        # Workers inherit the same session ticket keys from this context, so
+        # a client can resume its session with whichever worker it reaches.
+        ssl_context = make_sni_context(lambda: self.config)
+
+        for index in range(self.config.workers):
+            self.spawn_worker(index, sockets, ssl_context)
+
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.signal_workers)
+
+        log.info(f"Supervising {self.config.workers} workers")
+
+        while self.workers:
+            pid, status = os.wait()
+
+            index = self.workers.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+
+            log.warning(
+                f"Worker {index} (pid {pid}) exited with status {status}; restarting"
+            )
+
+            # Don't spin if workers are dying as soon as they start.
+            time.sleep(1)
+            if not self.stopping:
+                self.spawn_worker(index, sockets, ssl_context)
+
 
 def cli():
-    logging.basicConfig(level=logging.DEBUG)
-    ServerManager(sys.argv[1]).start()
+    # Configured before loading the configuration, so that anything logged
+    # while doing that shows up; the configured level applies after.
+    logging.basicConfig(level=logging.INFO)
+
+    manager = ServerManager(sys.argv[1])
+    logging.getLogger().setLevel(manager.config.log_level.upper())
+    manager.start()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,244 @@
+import asyncio
+import bisect
+import logging
+import os
+
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+log = logging.getLogger("amethyst.metrics")
+
+# Seconds; suits everything from a resumed handshake to a large download.
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def samples(self) -> Iterable[Tuple[str, Sequence[str], Sequence[str], float]]:
+        # (name suffix, label names, label values, value)
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+        for suffix, names, values, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(names, values)} "
+                f"{_format_value(value)}"
+            )
+
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+
+        # Without labels there's only the one value, so show it from the start.
+        self.values: Dict[Labels, float] = {} if labels else {(): 0}
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for values, value in self.values.items():
+            yield "", self.labels, values, value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, labels: Labels = ()):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+        # labels -> [count per bucket (the last being +Inf), sum]; counts are
+        # only made cumulative when rendering, to keep observe() cheap.
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def samples(self):
+        bucket_labels = self.labels + ("le",)
+
+        for values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _format_value(bound)
+                yield "_bucket", bucket_labels, values + (le,), cumulative
+
+            yield "_sum", self.labels, values, total[0]
+            yield "_count", self.labels, values, cumulative
+
+
+class Registry:
+    """A set of metrics, plus collectors producing more of them on demand.
+
+    Collectors are for values which are already being kept track of
+    elsewhere, which they turn into metrics when the registry is rendered.
+    """
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], Iterable[Metric]]] = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def collector(self, collector: Callable[[], Iterable[Metric]]):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self.metrics:
+            lines += metric.render()
+
+        for collector in self.collectors:
+            try:
+                for metric in collector():
+                    lines += metric.render()
+            except Exception:
+                log.exception(f"Metrics collector {collector!r} failed")
+
+        return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(
+    registry: Registry, address: str
+) -> asyncio.AbstractServer:
+    # A tiny HTTP/1.0 server for scrapers. The address is either a path to a
+    # Unix socket, or host:port, where the host defaults to localhost.
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+            path = request.split(b" ", 2)[1].split(b"?")[0]
+
+            if path == b"/metrics":
+                body = registry.render().encode()
+                status = b"200 OK"
+            else:
+                body = b"Not found\n"
+                status = b"404 Not Found"
+
+            writer.write(
+                b"HTTP/1.0 " + status + b"\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"\r\n" + body
+            )
+            await writer.drain()
+
+        except (
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+            IndexError,
+        ):
+            pass
+
+        finally:
+            writer.close()
+
+    if address.startswith("/"):
+        if os.path.exists(address):
+            os.unlink(address)
+
+        server = await asyncio.start_unix_server(handle, address)
+    else:
+        host, _, port = address.rpartition(":")
+        server = await asyncio.start_server(handle, host or "127.0.0.1", int(port))
+
+    log.info(f"Serving metrics on {address}")
+    return server
+
+
+def worker_address(address: str, index: int) -> str:
+    # Each worker serves its own metrics: Unix sockets get the worker's
+    # index as a suffix, and TCP ports are offset by it.
+    if address.startswith("/"):
+        return f"{address}.{index}"
+
+    host, _, port = address.rpartition(":")
+    return f"{host}:{int(port) + index}"
@@ -0,0 +1,67 @@
+import time
+
+from typing import Dict, Optional, Tuple
+
+
+class RateLimiter:
+    """Token-bucket rate limits, tracked per peer address.
+
+    Each peer may make up to `burst` requests back to back, after which it
+    gets `rate` requests per second.
+    """
+
+    def __init__(
+        self, rate: float, burst: Optional[float] = None, max_peers: int = 65536
+    ):
+        if rate <= 0:
+            raise ValueError(f"Rate limit must be above 0, not {rate!r}")
+
+        if burst is not None and burst < 1:
+            raise ValueError(f"Rate limit burst must be at least 1, not {burst!r}")
+
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self.max_peers = max_peers
+
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(cfg["rate"], cfg.get("burst"), cfg.get("max_peers", 65536))
+
+    def check(self, peer: str) -> float:
+        # Returns 0 if the peer may go ahead, otherwise the number of seconds
+        # until it will have a token again.
+        now = time.monotonic()
+
+        bucket = self.buckets.get(peer)
+        if bucket is None:
+            if len(self.buckets) >= self.max_peers:
+                self._prune(now)
+
+            tokens = self.burst
+        else:
+            tokens, updated = bucket
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        if tokens >= 1:
+            self.buckets[peer] = tokens - 1, now
+            return 0
+
+        self.buckets[peer] = tokens, now
+        self.rejected += 1
+        return (1 - tokens) / self.rate
+
+    def _prune(self, now: float):
+        # Buckets which have refilled completely are the same as no bucket.
+        self.buckets = {
+            peer: (tokens, updated)
+            for peer, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * self.rate < self.burst
+        }
+
+        # Still full of active peers; forget everyone rather than grow
+        # without bound.
+        if len(self.buckets) >= self.max_peers:
+            self.buckets.clear()
@@ -2,15 +2,24 @@ from dataclasses import dataclass, field
 from typing import Any, Dict, Optional
 
 from .server import Server
+from .util import add_slots
 
+# These are made for every request, so they have slots rather than a
+# __dict__ per instance.
 
+
+@add_slots
 @dataclass
 class Connection:
     server: Server
     peer_addr: str
     peer_cert: Optional[bytes] = None
 
+    # The configured host the request was for, once the handler knows it.
+    host: Optional[str] = None
+
 
+@add_slots
 @dataclass
 class Context:
     host: str
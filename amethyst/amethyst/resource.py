@@ -1,13 +1,17 @@
 import asyncio
 import configparser
+import dataclasses
 import enum
 import logging
 import mimetypes
 import os
 import os.path
 import subprocess
+import time
 
-from .response import Status, Response
+from .cache import LRUCache
+from .gateway import CGIOutput, cgi_environ
+from .response import CGITimeoutError, FileBody, Status, Response
 from .request import Context
 
 from dataclasses import dataclass
@@ -57,6 +61,14 @@ class Meta:
 
 DEFAULT_META = Meta(cgi=False, autoindex=False, index="index.gmi", mime_type=None)
 
+MetaSignature = Optional[Tuple[int, int, int]]
+
+
+class MetaCacheEntry(NamedTuple):
+    checked_at: float
+    signatures: Tuple[MetaSignature, ...]
+    metas: Dict[str, Meta]
+
 
 class FilesystemResource:
     def __init__(
@@ -65,101 +77,191 @@ class FilesystemResource:
         cgi=False,
         mime_types=None,
         default_mime_type="application/octet-stream",
+        stream_threshold=65536,
+        cache_size=0,
+        meta_check_interval=1.0,
+        listing_cache_size=1048576,
+        cgi_timeout=60,
+        cgi_max_processes=32,
+        cgi_eof_wait=0.01,
     ):
 
         self.log = logging.getLogger("amethyst.resource.FilesystemResource")
         self.cgi_log = logging.getLogger("amethyst.resource.FilesystemResource.cgi")
 
         self.cgi = cgi
+        self.cgi_timeout = cgi_timeout
+        self.cgi_max_processes = cgi_max_processes
+        self.cgi_eof_wait = cgi_eof_wait
+        self._cgi_slots: Optional[asyncio.Semaphore] = None
 
         self.default_mime_type = default_mime_type
+        self.stream_threshold = stream_threshold
         self.root = os.path.abspath(root)
 
+        # Files small enough to be sent from memory are kept here, keyed by
+        # path and validated against a fresh stat on every hit.
+        self.cache: Optional[LRUCache[Tuple[bytes, Optional[str]]]] = None
+        if cache_size:
+            self.cache = LRUCache(cache_size)
+
+        # Parsed .meta files by path, and the merged metadata for each
+        # directory. Merged entries are trusted for meta_check_interval
+        # seconds, then revalidated by stat'ing the .meta files they came from.
+        self.meta_check_interval = meta_check_interval
+        self._meta_files: Dict[str, Tuple[MetaSignature, Dict[str, Meta]]] = {}
+        self._meta_cache: Dict[Tuple[str, int], MetaCacheEntry] = {}
+
+        # Rendered autoindex listings, keyed by directory and validated
+        # against the directory's mtime.
+        self._listings: Optional[LRUCache[bytes]] = None
+        if listing_cache_size:
+            self._listings = LRUCache(listing_cache_size)
+
+    @property
+    def cgi_slots(self) -> asyncio.Semaphore:
+        # Made on first use rather than up front: resources are built on a
+        # worker thread when reloading, and before Python 3.10, a semaphore
+        # needs an event loop in the thread it's made in.
+        if self._cgi_slots is None:
+            self._cgi_slots = asyncio.Semaphore(self.cgi_max_processes)
+
+        return self._cgi_slots
+
+    def caches(self) -> Dict[str, LRUCache]:
+        caches: Dict[str, LRUCache] = {}
+        if self.cache is not None:
+            caches["files"] = self.cache
+        if self._listings is not None:
+            caches["listings"] = self._listings
+
+        return caches
+
+    def _guess_mime_type(self, filename: str) -> str:
+        mime_type, _encoding = mimetypes.guess_type(filename, strict=False)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(f"mimetypes says {filename=} has {mime_type=}")
+
+        if mime_type is None:
+            return self.default_mime_type
+
+        return mime_type
+
     def send_file(self, filename: str, mime_type: Optional[str] = None) -> Response:
+        if self.cache is not None:
+            st = os.stat(filename)
+            cached = self.cache.get(filename, (st.st_mtime_ns, st.st_size, st.st_ino))
+
+            if cached is not None:
+                contents, guessed_mime_type = cached
+                if self.log.isEnabledFor(logging.DEBUG):
+                    self.log.debug(
+                        f"Sending cached file {filename} ({len(contents)} bytes)"
+                    )
+
+                if mime_type is None:
+                    if guessed_mime_type is None:
+                        # Cached while .meta still gave it a type.
+                        guessed_mime_type = self._guess_mime_type(filename)
+                    mime_type = guessed_mime_type
+
+                return Response(Status.SUCCESS, mime_type, contents)
+
+        f = open(filename, "rb")
+        st = os.fstat(f.fileno())
+
+        # Only guessed when .meta doesn't say, since guessing isn't free.
+        guessed_mime_type = None
         if mime_type is None:
-            mime_type = self.default_mime_type
+            mime_type = guessed_mime_type = self._guess_mime_type(filename)
 
-            candidate_mime_type, _encoding = mimetypes.guess_type(
-                filename, strict=False
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(
+                f"Sending file {filename} ({st.st_size} bytes) as {mime_type}"
             )
-            self.log.debug(f"mimetypes says {filename=} has {candidate_mime_type=}")
-            if candidate_mime_type is not None:
-                mime_type = candidate_mime_type
 
-        with open(filename, "rb") as f:
+        # Large files are streamed from disk so memory use per connection
+        # doesn't grow with the size of the file being served.
+        if st.st_size > self.stream_threshold:
+            return Response(Status.SUCCESS, mime_type, FileBody(f, st.st_size))
+
+        with f:
             contents = f.read()
 
-        self.log.debug(
-            f"Sending file {filename} ({len(contents)} bytes) as {mime_type}"
-        )
+        if self.cache is not None:
+            self.cache.put(
+                filename,
+                (st.st_mtime_ns, st.st_size, st.st_ino),
+                (contents, guessed_mime_type),
+                len(contents),
+            )
 
         return Response(Status.SUCCESS, mime_type, contents)
 
     async def do_cgi(self, ctx: Context, path_info: PathInfo) -> Response:
-        # TODO: signal client certificates here
-        env = {
-            "GATEWAY_INTERFACE": "CGI/1.1",
-            "QUERY_STRING": ctx.query or "",
-            "REMOTE_ADDR": ctx.conn.peer_addr[0],
-            "SCRIPT_NAME": "/".join([""] + path_info.original_path_components),
-            "PATH_INFO": path_info.extra,
-            "SERVER_NAME": ctx.host,
-            "SERVER_PORT": str(ctx.conn.server.config.port),
-            "SERVER_PROTOCOL": "Gemini/0.16.0",
-            "SERVER_SOFTWARE": "Amethyst",
-        }
-
-        self.log.debug(f"Starting CGI script {path_info.path}")
-
-        proc = await asyncio.create_subprocess_exec(
-            path_info.path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=(os.environ | env),
-        )
-
-        stdout, stderr = await proc.communicate()
-
-        self.cgi_log.info(
-            f"{path_info.path} returned {proc.returncode} "
-            f"(stdout bytes {len(stdout)}, "
-            f"stderr bytes {len(stderr)})"
-        )
-
-        if proc.returncode != 0:
-            self.cgi_log.warn("Script stderr:")
-            self.cgi_log.warn(stderr)
-            return Response(
-                Status.CGI_ERROR, f"Script returned {proc.returncode} (see logs)"
+        if self.cgi_slots.locked():
+            self.cgi_log.warning(
+                f"Too many CGI scripts running; not starting {path_info.path}"
             )
+            return Response(Status.SERVER_UNAVAILABLE, "Server busy; try again later")
 
-        content_type = "text/gemini"
-        status = Status.SUCCESS
+        env = cgi_environ(
+            ctx, "/".join([""] + path_info.original_path_components), path_info.extra
+        )
 
-        lines = iter(stdout.split(b"\n"))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(f"Starting CGI script {path_info.path}")
 
-        for line in lines:
-            if not line or b":" not in line:
-                break
+        await self.cgi_slots.acquire()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                path_info.path,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=(os.environ | env),
+                start_new_session=True,
+            )
+        except BaseException:
+            self.cgi_slots.release()
+            raise
 
-            key, value = line.decode().strip().split(":", maxsplit=1)
-            key, value = key.strip().lower(), value.strip()
+        output = CGIOutput(
+            proc, path_info.path, self.cgi_timeout, self.cgi_log, self.cgi_slots.release
+        )
 
-            if key == "content-type":
-                content_type = value
-            elif key == "status":
-                try:
-                    status = Status(int(value))
-                except ValueError:
-                    pass
-            elif key == "location":
-                return Response(Status.REDIRECT_TEMPORARY, value)
+        try:
+            status, meta = await output.read_headers()
+            complete = not status.is_success() or await output.read_ahead(
+                self.stream_threshold, self.cgi_eof_wait
+            )
+        except asyncio.TimeoutError:
+            await output.aclose()
+            ctx.conn.server.timeouts["cgi"] += 1
+            return Response(Status.CGI_ERROR, "Script timed out (see logs)")
+
+        if complete:
+            # The script was done writing almost as soon as its headers were
+            # in, so let it exit first; that way a failing script is still
+            # reported as an error. Anything slower is streamed, and once
+            # it's started going out, the exit status can't change the
+            # response.
+            content = output.pending
+            try:
+                await output.drain()
+            except CGITimeoutError:
+                ctx.conn.server.timeouts["cgi"] += 1
+                return Response(Status.CGI_ERROR, "Script timed out (see logs)")
+
+            if output.returncode != 0:
+                return Response(
+                    Status.CGI_ERROR, f"Script returned {output.returncode} (see logs)"
+                )
 
-        result = b"\n".join(lines)
-        if line:
-            result = line + b"\n" + result
+            return Response(status, meta, content)
 
-        return Response(status, content_type, result)
+        # Otherwise the header goes out now, and the body as the script
+        # produces it.
+        return Response(status, meta, output)
 
     # Flow should be:
     # - Find what file (or directory) we are actually processing
@@ -184,14 +286,17 @@ class FilesystemResource:
             else:
                 normalized.append(component)
 
-        logging.debug(f"find_path: {normalized=}")
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.log.debug(f"find_path: {normalized=}")
 
         for up_to in range(len(normalized) + 1, 0, -1):
             original_path_components = normalized[:up_to]
             path = os.path.join(self.root, *normalized[:up_to])
             extra = "/".join(normalized[up_to:])
 
-            logging.debug(f"find_path: test {path=}")
+            if debug:
+                self.log.debug(f"find_path: test {path=}")
 
             if os.path.exists(path):
                 break
@@ -203,18 +308,15 @@ class FilesystemResource:
         return PathInfo(original_path_components, path, extra, file_type)
 
     @staticmethod
-    def _find_meta(info: PathInfo) -> Tuple[Optional[str], List[str]]:
+    def _meta_candidates(info: PathInfo) -> Tuple[str, List[str]]:
         if info.file_type == FileType.DIRECTORY:
             dir_name = info.path
         elif info.file_type == FileType.FILE:
             dir_name = os.path.dirname(info.path)
 
-        dir_inherited_meta_filenames = []
+        dir_inherited_meta_candidates = []
 
         exact_meta_candidate = os.path.join(dir_name, ".meta")
-        exact_meta: Optional[str] = None
-        if os.path.exists(exact_meta_candidate):
-            exact_meta = exact_meta_candidate
 
         # Walk up the tree until we run out of directories
         for component in info.original_path_components:
@@ -222,62 +324,156 @@ class FilesystemResource:
             dir_name = dir_name[: dir_name.rindex("/")]
 
             candidate = os.path.join(dir_name, ".meta")
-            if os.path.exists(candidate):
-                dir_inherited_meta_filenames.append(candidate)
+            dir_inherited_meta_candidates.append(candidate)
 
         # order returned in the order we should load them (last wins)
-        return exact_meta, dir_inherited_meta_filenames[::-1]
+        return exact_meta_candidate, dir_inherited_meta_candidates[::-1]
 
-    @classmethod
-    def _load_meta(cls, info: PathInfo) -> Dict[str, Meta]:
-        def _load_inner(f: str):
-            result = {}
+    @staticmethod
+    def _stat_signature(filename: str) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    @staticmethod
+    def _parse_meta_file(f: str) -> Dict[str, Meta]:
+        result = {}
 
-            p = configparser.ConfigParser()
-            p.read(f)
+        p = configparser.ConfigParser()
+        p.read(f)
 
-            result["."] = Meta()
+        result["."] = Meta()
 
-            for sec in p.sections():
-                result[sec] = Meta()
+        for sec in p.sections():
+            result[sec] = Meta()
 
-                # XXX: Load dynamically later?
-                result[sec].cgi = p.getboolean(sec, "cgi", fallback=None)
-                result[sec].autoindex = p.getboolean(sec, "autoindex", fallback=None)
+            # XXX: Load dynamically later?
+            result[sec].cgi = p.getboolean(sec, "cgi", fallback=None)
+            result[sec].autoindex = p.getboolean(sec, "autoindex", fallback=None)
 
-                # this is to satisfy the typechecker
-                index_candidate = p.get(sec, "index", fallback=None)
-                if index_candidate is not None:
-                    result[sec].index = str(index_candidate)
+            # this is to satisfy the typechecker
+            index_candidate = p.get(sec, "index", fallback=None)
+            if index_candidate is not None:
+                result[sec].index = str(index_candidate)
 
-                mime_type_candidate = p.get(sec, "mime", fallback=None)
-                if mime_type_candidate is not None:
-                    result[sec].mime_type = str(mime_type_candidate)
+            mime_type_candidate = p.get(sec, "mime", fallback=None)
+            if mime_type_candidate is not None:
+                result[sec].mime_type = str(mime_type_candidate)
 
-            return result
+        return result
 
-        exact_meta_file, inherited_meta_files = cls._find_meta(info)
+    def _read_meta_file(
+        self, filename: str, signature: MetaSignature
+    ) -> Dict[str, Meta]:
+        cached = self._meta_files.get(filename)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        result = self._parse_meta_file(filename)
+        self._meta_files[filename] = signature, result
+        return result
+
+    def _load_meta(self, info: PathInfo) -> Dict[str, Meta]:
+        if info.file_type == FileType.DIRECTORY:
+            cache_key = info.path, len(info.original_path_components)
+        else:
+            cache_key = os.path.dirname(info.path), len(info.original_path_components)
+
+        now = time.monotonic()
+        cached = self._meta_cache.get(cache_key)
+        if cached is not None and now - cached.checked_at < self.meta_check_interval:
+            return cached.metas
+
+        exact_meta_file, inherited_meta_files = self._meta_candidates(info)
+        signatures = tuple(
+            self._stat_signature(filename)
+            for filename in [exact_meta_file] + inherited_meta_files
+        )
+
+        if cached is not None and cached.signatures == signatures:
+            self._meta_cache[cache_key] = cached._replace(checked_at=now)
+            return cached.metas
 
         inherited_meta = Meta()
-        for filename in inherited_meta_files:
-            inherited_meta.merge_from(_load_inner(filename)["."])
+        for filename, signature in zip(inherited_meta_files, signatures[1:]):
+            if signature is not None:
+                inherited_meta.merge_from(
+                    self._read_meta_file(filename, signature)["."]
+                )
 
         exact_metas = {".": Meta()}
 
-        if exact_meta_file is not None:
-            exact_metas.update(_load_inner(exact_meta_file))
+        if signatures[0] is not None:
+            # Parsed files are shared between directories, so copy before
+            # merging into them.
+            exact_metas.update(
+                (sec, dataclasses.replace(meta))
+                for sec, meta in self._read_meta_file(
+                    exact_meta_file, signatures[0]
+                ).items()
+            )
 
         exact_metas["."].merge_from(inherited_meta)
 
         for key, meta in exact_metas.items():
             meta.merge_from(DEFAULT_META)
 
+        self._meta_cache[cache_key] = MetaCacheEntry(now, signatures, exact_metas)
         return exact_metas
 
+    def _list_directory(self, path: str) -> bytes:
+        st = os.stat(path)
+        tag = st.st_mtime_ns, st.st_ino
+
+        if self._listings is not None:
+            cached = self._listings.get(path, tag)
+            if cached is not None:
+                return cached
+
+        # scandir gets entry types from the directory itself, so this doesn't
+        # need a stat per entry (except for symlinks).
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+
+        lines = [""]
+        for entry in entries:
+            if entry.is_dir():
+                lines.append(f"=> {entry.name}/")
+            elif entry.name != ".meta":
+                lines.append(f"=> {entry.name}")
+
+        listing = "\n".join(lines).encode()
+
+        if self._listings is not None:
+            self._listings.put(path, tag, listing, len(listing))
+
+        return listing
+
     async def __call__(self, ctx: Context) -> Response:
+        # Everything up to running a CGI script is blocking disk I/O, so it
+        # happens on the server's I/O thread pool instead of the event loop.
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(ctx.conn.server.executor, self._handle, ctx)
+
+        if isinstance(result, PathInfo):
+            return await self.do_cgi(ctx, result)
+
+        return result
+
+    # Returns either the response, or the path info of a CGI script which
+    # should be run (asynchronously) to produce one.
+    def _handle(self, ctx: Context) -> Union[Response, PathInfo]:
+        # Checked once per request, so that none of the messages below are
+        # formatted (dataclass reprs and all) unless they'll be logged.
+        debug = self.log.isEnabledFor(logging.DEBUG)
+
         try:
             path_info = self._find_path(ctx)
-            logging.debug(f"{path_info=}")
+            if debug:
+                self.log.debug(f"{path_info=}")
         except InvalidPathException:
             self.log.warn(f"_find_path threw for invalid path {ctx.path=}!")
             return Response(Status.BAD_REQUEST, "Invalid path")
@@ -290,7 +486,8 @@ class FilesystemResource:
         meta = self._load_meta(path_info)
         dir_meta = meta["."]
 
-        logging.debug(f"{dir_meta=}")
+        if debug:
+            self.log.debug(f"{dir_meta=}")
 
         if path_info.file_type == FileType.DIRECTORY:
             # do dirindex processing if needed
@@ -312,30 +509,25 @@ class FilesystemResource:
 
             # else handle autoindex right now
             elif dir_meta.autoindex:
-                self.log.debug(
-                    f"Performing directory listing of {path_info.path} for request to {ctx.orig_path}"
-                )
-
-                lines = [f"# Directory listing of {ctx.orig_path}", ""]
-
-                for filename in sorted(os.listdir(path_info.path)):
-                    if os.path.isdir(os.path.join(path_info.path, filename)):
-                        lines.append(f"=> {filename}/")
-                    elif filename != ".meta":
-                        lines.append(f"=> {filename}")
+                if debug:
+                    self.log.debug(
+                        f"Performing directory listing of {path_info.path} for request to {ctx.orig_path}"
+                    )
 
-                listing = "\n".join(lines).encode()
+                header = f"# Directory listing of {ctx.orig_path}\n".encode()
+                listing = header + self._list_directory(path_info.path)
                 return Response(Status.SUCCESS, "text/gemini", listing)
 
             else:
-                self.log.debug(f"{path_info.path} not found")
+                if debug:
+                    self.log.debug(f"{path_info.path} not found")
                 return Response(
                     Status.NOT_FOUND, f"{ctx.orig_path} was not found on this server."
                 )
 
         # .meta itself can never ever be processed as a file
         if path_info.original_path_components[-1] == ".meta":
-            logging.warn(
+            self.log.warn(
                 "Directly accessing .meta is not supported and will always return NOT_FOUND"
             )
             return Response(
@@ -344,19 +536,20 @@ class FilesystemResource:
 
         file_meta = meta.get(path_info.original_path_components[-1])
         if file_meta is None:
-            logging.debug("file_meta is falling back to dir_meta")
             file_meta = dir_meta
 
-        logging.debug(f"{file_meta=}")
+        if debug:
+            self.log.debug(f"{file_meta=}")
 
         # _not_ elif, since we might've rewritten path_info above
         if path_info.file_type == FileType.FILE and os.path.isfile(path_info.path):
             if self.cgi and file_meta.cgi and os.access(path_info.path, os.X_OK):
-                return await self.do_cgi(ctx, path_info)
+                return path_info
 
             return self.send_file(path_info.path, mime_type=file_meta.mime_type)
 
-        self.log.debug(f"{path_info.path} not found")
+        if debug:
+            self.log.debug(f"{path_info.path} not found")
         return Response(
             Status.NOT_FOUND, f"{ctx.orig_path} was not found on this server."
         )
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from enum import Enum
-from typing import Optional
+from typing import AsyncIterable, BinaryIO, Dict, Optional, Union
+
+from .util import add_slots
 
 
 class Status(Enum):
@@ -24,11 +26,72 @@ class Status(Enum):
     CERTIFICATE_NOT_VALID = 62
 
     def is_success(self):
-        return 20 <= self.value <= 29
+        # Cheaper than going through .value, which is a property on enums.
+        return self in SUCCESS_STATUSES
+
+
+SUCCESS_STATUSES = frozenset(status for status in Status if 20 <= status.value <= 29)
+
+
+# Headers of successful responses, by MIME type. Only so many of those are
+# ever in use, and most responses have one of them, so each is only
+# formatted and encoded once. Other metas (error messages, redirect
+# targets, ...) are often made from the request, so they aren't kept.
+SUCCESS_HEADERS: Dict[str, bytes] = {}
+SUCCESS_HEADERS_LIMIT = 256
+
+
+def encode_header(status: Status, meta: str) -> bytes:
+    if status is not Status.SUCCESS:
+        return f"{status.value} {meta}\r\n".encode()
+
+    header = SUCCESS_HEADERS.get(meta)
+    if header is None:
+        header = f"20 {meta}\r\n".encode()
+        if len(SUCCESS_HEADERS) < SUCCESS_HEADERS_LIMIT:
+            SUCCESS_HEADERS[meta] = header
+
+    return header
+
+
+class FileBody:
+    """A response body backed by an open file.
 
+    The server sends it in bounded chunks (or with sendfile(2), where the
+    transport supports it) and closes the file once the response is done.
+    """
 
+    def __init__(self, file: BinaryIO, size: int):
+        self.file = file
+        self.size = size
+
+    def close(self):
+        self.file.close()
+
+
+class CGITimeoutError(Exception):
+    """Raised by a streamed CGI (or SCGI) body whose script ran out of time.
+
+    `body_bytes` is how much of the body had been produced before then.
+    """
+
+    def __init__(self, name: str, body_bytes: int):
+        super().__init__(f"{name} timed out")
+        self.body_bytes = body_bytes
+
+
+# Content is either the whole body, an open file, or an async iterator of
+# chunks which the server writes out as they're produced.
+Body = Union[bytes, FileBody, AsyncIterable[bytes]]
+
+
+@add_slots
 @dataclass
 class Response:
     status_code: Status
     meta: str
-    content: Optional[bytes] = None
+    content: Optional[Body] = None
+
+    @property
+    def header(self) -> bytes:
+        return encode_header(self.status_code, self.meta)
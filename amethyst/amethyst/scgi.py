@@ -0,0 +1,382 @@
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .gateway import CHUNK_SIZE, cgi_environ, read_cgi_headers
+from .request import Context
+from .response import CGITimeoutError, Response, Status
+
+
+def encode_request(env: Dict[str, str]) -> bytes:
+    # SCGI requests are a netstring of NUL-separated headers, of which
+    # CONTENT_LENGTH must come first. Gemini requests never have a body.
+    headers = {"CONTENT_LENGTH": "0", "SCGI": "1", **env}
+    payload = b"".join(f"{key}\0{value}\0".encode() for key, value in headers.items())
+    return str(len(payload)).encode() + b":" + payload + b","
+
+
+class SCGIWorker:
+    def __init__(
+        self,
+        socket_path: str,
+        command: Optional[List[str]] = None,
+        env: Optional[Dict[str, str]] = None,
+    ):
+        self.socket_path = socket_path
+        self.command = command
+        self.env = env or {}
+
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.busy = 0
+        self.failures = 0
+
+        self._restarting: Optional[asyncio.Task] = None
+
+    @property
+    def managed(self) -> bool:
+        return self.command is not None
+
+    def alive(self) -> bool:
+        return not self.managed or (
+            self.proc is not None and self.proc.returncode is None
+        )
+
+    async def start(self):
+        assert self.command is not None
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self.proc = await asyncio.create_subprocess_exec(
+            *self.command,
+            env=os.environ | self.env | {"SCGI_SOCKET": self.socket_path},
+            start_new_session=True,
+        )
+        self.failures = 0
+
+    async def stop(self):
+        # A restart under way would start a process after we're done here,
+        # so let it finish first.
+        if self._restarting is not None:
+            await asyncio.wait([self._restarting])
+
+        if self.proc is None or self.proc.returncode is not None:
+            return
+
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    async def restart(self):
+        # Requests and health checks may all find the worker dead at once;
+        # they share one restart, which carries on if any of them give up.
+        if self._restarting is None:
+            self._restarting = asyncio.get_running_loop().create_task(self._restart())
+
+        await asyncio.shield(self._restarting)
+
+    async def _restart(self):
+        try:
+            # Whatever state the old process is in, it isn't answering us,
+            # so don't wait around for it to exit cleanly.
+            if self.proc is not None and self.proc.returncode is None:
+                try:
+                    os.killpg(self.proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+                await self.proc.wait()
+
+            await self.start()
+
+        finally:
+            self._restarting = None
+
+
+async def check_health(
+    workers: List[SCGIWorker], interval: float, timeout: float, log: logging.Logger
+):
+    while True:
+        await asyncio.sleep(interval)
+
+        for worker in workers:
+            if not worker.alive():
+                log.warning(f"SCGI worker {worker.socket_path} exited")
+                await worker.restart()
+                continue
+
+            try:
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_unix_connection(worker.socket_path), timeout
+                )
+                writer.close()
+                worker.failures = 0
+
+            except (OSError, asyncio.TimeoutError):
+                worker.failures += 1
+
+                if worker.failures >= 3 and worker.managed:
+                    log.warning(
+                        f"SCGI worker {worker.socket_path} failed "
+                        f"{worker.failures} health checks; restarting it"
+                    )
+                    await worker.restart()
+
+
+class SCGIOutput:
+    """The body of an SCGI response, streamed from the application's socket."""
+
+    def __init__(
+        self,
+        name: str,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        deadline: Optional[float],
+        on_close: Callable[[], None],
+    ):
+        self.name = name
+        self.body_bytes = 0
+        self.reader = reader
+        self.writer = writer
+        self.deadline = deadline
+        self.on_close: Optional[Callable[[], None]] = on_close
+        self.pending = b""
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+
+        return max(0.0, self.deadline - time.monotonic())
+
+    async def read_headers(self) -> Tuple[Status, str]:
+        try:
+            status, meta, self.pending = await asyncio.wait_for(
+                read_cgi_headers(self.reader, allow_empty=False), self.remaining()
+            )
+        except BaseException:
+            await self.aclose()
+            raise
+
+        return status, meta
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.pending:
+            chunk, self.pending = self.pending, b""
+
+        else:
+            try:
+                chunk = await asyncio.wait_for(
+                    self.reader.read(CHUNK_SIZE), self.remaining()
+                )
+            except asyncio.TimeoutError:
+                await self.aclose()
+                raise CGITimeoutError(self.name, self.body_bytes) from None
+            except BaseException:
+                await self.aclose()
+                raise
+
+            if not chunk:
+                await self.aclose()
+                raise StopAsyncIteration
+
+        self.body_bytes += len(chunk)
+        return chunk
+
+    async def aclose(self):
+        if self.on_close is None:
+            return
+
+        self.on_close()
+        self.on_close = None
+        self.writer.close()
+
+
+class SCGIResource:
+    """Serves requests from long-running application processes over SCGI.
+
+    Either give a `command`, which is started `workers` times with the Unix
+    socket it should listen on in $SCGI_SOCKET, or the `socket` of an SCGI
+    server managed elsewhere. Requests get the same environment a CGI
+    script would (without the server's own environment), and responses use
+    the same header format as CGI output.
+    """
+
+    def __init__(
+        self,
+        command=None,
+        socket=None,
+        workers=1,
+        socket_dir=None,
+        env=None,
+        timeout=60,
+        connect_timeout=5,
+        health_check_interval=10,
+    ):
+        if (command is None) == (socket is None):
+            raise ValueError("SCGI resource needs exactly one of command or socket")
+
+        self.log = logging.getLogger("amethyst.scgi.SCGIResource")
+
+        if isinstance(command, str):
+            command = [command]
+
+        self.command = command
+        self.socket = socket
+        self.num_workers = workers
+        self.socket_dir = socket_dir or os.getenv(
+            "RUNTIME_DIRECTORY", tempfile.gettempdir()
+        )
+        self.env = env or {}
+
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.health_check_interval = health_check_interval
+
+        self.workers: List[SCGIWorker] = []
+        self._started_in: Optional[int] = None
+        self._private_dir: Optional[str] = None
+        self._health_tasks: List[asyncio.Task] = []
+
+    async def _ensure_started(self):
+        # Workers are started per server process, on first use; after a fork,
+        # the parent's workers (if any) aren't ours to use.
+        if self._started_in == os.getpid():
+            return
+
+        self._started_in = os.getpid()
+        self.workers.clear()
+        self._health_tasks.clear()
+
+        if self.command is None:
+            self.workers.append(SCGIWorker(self.socket))
+            return
+
+        # Sockets go in a directory only we can get into (mkdtemp makes it
+        # 0700), so that nobody else can bind them before the app does, and
+        # be sent requests meant for it.
+        self._private_dir = tempfile.mkdtemp(
+            prefix="amethyst-scgi-", dir=self.socket_dir
+        )
+
+        for index in range(self.num_workers):
+            path = os.path.join(self._private_dir, f"{index}.sock")
+            self.workers.append(SCGIWorker(path, self.command, self.env))
+
+        if self.health_check_interval:
+            task = asyncio.get_running_loop().create_task(
+                check_health(
+                    self.workers,
+                    self.health_check_interval,
+                    self.connect_timeout,
+                    self.log,
+                )
+            )
+            self._health_tasks.append(task)
+
+        # Other requests arriving meanwhile find the workers not yet alive,
+        # and wait on the same restarts.
+        await asyncio.gather(*(worker.restart() for worker in self.workers))
+        self.log.info(f"Started {self.num_workers} SCGI workers: {self.command}")
+
+    async def close(self):
+        # Called once this resource is no longer configured, or the server
+        # is shutting down. Only the workers this process started are ours
+        # to stop.
+        if self._started_in != os.getpid():
+            return
+
+        for task in self._health_tasks:
+            task.cancel()
+
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+        self.log.info(f"Stopped {len(self.workers)} SCGI workers: {self.command}")
+
+        if self._private_dir is not None:
+            shutil.rmtree(self._private_dir, ignore_errors=True)
+            self._private_dir = None
+
+        self._started_in = None
+
+    async def _connect(self, worker: SCGIWorker):
+        # Freshly (re)started workers may not be listening yet, so keep
+        # trying for a little while.
+        deadline = time.monotonic() + self.connect_timeout
+
+        while True:
+            try:
+                return await asyncio.wait_for(
+                    asyncio.open_unix_connection(worker.socket_path),
+                    max(0.0, deadline - time.monotonic()),
+                )
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline or not worker.alive():
+                    raise
+
+                await asyncio.sleep(0.05)
+
+    async def __call__(self, ctx: Context) -> Response:
+        await self._ensure_started()
+
+        worker = min(self.workers, key=lambda w: w.busy)
+        if not worker.alive():
+            if worker._restarting is None:
+                self.log.warning(
+                    f"SCGI worker {worker.socket_path} exited; restarting it"
+                )
+            await worker.restart()
+
+        script_name = ctx.orig_path
+        if ctx.path and script_name.endswith(ctx.path):
+            script_name = script_name[: -len(ctx.path)]
+
+        env = cgi_environ(ctx, script_name.rstrip("/"), ctx.path)
+
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+
+        worker.busy += 1
+
+        def release():
+            worker.busy -= 1
+
+        try:
+            reader, writer = await self._connect(worker)
+        except (OSError, asyncio.TimeoutError) as e:
+            release()
+            self.log.error(f"Can't connect to SCGI worker {worker.socket_path}: {e!r}")
+            return Response(Status.CGI_ERROR, "Application unavailable (see logs)")
+
+        writer.write(encode_request(env))
+        output = SCGIOutput(worker.socket_path, reader, writer, deadline, release)
+
+        try:
+            status, meta = await output.read_headers()
+        except asyncio.TimeoutError:
+            self.log.warning(f"SCGI worker {worker.socket_path} timed out")
+            ctx.conn.server.timeouts["cgi"] += 1
+            return Response(Status.CGI_ERROR, "Application timed out (see logs)")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.log.warning(f"SCGI worker {worker.socket_path} sent no response")
+            return Response(Status.CGI_ERROR, "Application failed (see logs)")
+
+        if not status.is_success():
+            await output.aclose()
+            return Response(status, meta)
+
+        return Response(status, meta, output)
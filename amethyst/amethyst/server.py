@@ -1,40 +1,317 @@
 #!/usr/bin/env python3
 
 import asyncio
+import datetime
 import logging
 import signal
+import socket
+import ssl
+import time
 import traceback
-from typing import TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterable, List, Optional, Set, cast
 
-from .response import Response, Status
+from .accesslog import AccessLog, AccessLogEntry
+from .metrics import Counter, Gauge, Metric, Registry
+from .response import Body, CGITimeoutError, FileBody, Response, Status
 from .tls import make_sni_context
 
 if TYPE_CHECKING:
     from .config import Config
 
 
+MAX_URL_LENGTH = 1024
+
+# Bodies up to this size are sent along with the header, in a single write
+# (and so a single TLS record, this being the most a record holds).
+SMALL_BODY_SIZE = 16384
+
+# Label values for Server.stage_seconds
+STAGE_HANDSHAKE = ("handshake",)
+STAGE_READ = ("read",)
+STAGE_HANDLER = ("handler",)
+STAGE_WRITE = ("write",)
+
+
+def bind(port: int, reuse_port: bool = False) -> List[socket.socket]:
+    # One socket per address family, like asyncio.start_server, so IPv4
+    # peers keep showing up with IPv4 addresses.
+    infos = socket.getaddrinfo(
+        None, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+    )
+
+    return [
+        socket.create_server(addr, family=family, backlog=100, reuse_port=reuse_port)
+        for family, addr in {(info[0], info[4]) for info in infos}
+    ]
+
+
 class Server:
     def __init__(
         self,
         config: "Config",
+        sockets: Optional[List[socket.socket]] = None,
+        ssl_context: Optional[ssl.SSLContext] = None,
     ):
         self.log = logging.getLogger("amethyst.server")
-        self.access_log = logging.getLogger("amethyst.access")
+        self.access_log = AccessLog.from_config(config.access_log)
 
         self.server = None
         self.config = config
+        self.sockets = sockets
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.io_threads, thread_name_prefix="amethyst-io"
+        )
+
+        # Total time the event loop spent running late; see watch_loop.
+        self.loop_blocked_seconds = 0.0
+
+        self.connections = 0
+        self.rejected_connections = 0
+        self.timeouts = {"handshake": 0, "request": 0, "response": 0, "cgi": 0}
+
+        # Completed TLS handshakes, by whether they resumed a session.
+        self.handshakes = {"full": 0, "resumed": 0}
 
-        self.ssl_context = make_sni_context(config)
+        self.metrics = Registry()
+        self.metrics.collector(self.collect_metrics)
+
+        self.connections_total = self.metrics.counter(
+            "amethyst_connections_total", "Connections accepted."
+        )
+        self.responses_total = self.metrics.counter(
+            "amethyst_responses_total",
+            "Responses sent, by host and status code.",
+            ("host", "status"),
+        )
+        self.response_bytes = self.metrics.counter(
+            "amethyst_response_bytes_total",
+            "Bytes of responses written, by host.",
+            ("host",),
+        )
+        self.stage_seconds = self.metrics.histogram(
+            "amethyst_stage_seconds",
+            "Time spent on each stage of a connection: TLS handshake, reading "
+            "the request, running the handler, and writing the response.",
+            ("stage",),
+        )
+
+        self.tasks: Set[asyncio.Task] = set()
+        self.accept_tasks: List[asyncio.Task] = []
+
+        self.ssl_context = ssl_context or make_sni_context(lambda: self.config)
         self.server = self.get_server()
 
     def get_server(self):
-        loop = asyncio.get_event_loop()
+        return self.listen()
+
+    async def listen(self):
+        sockets = self.sockets
+        if sockets is None:
+            sockets = self.sockets = bind(self.config.port, self.config.reuse_port)
+
+        loop = asyncio.get_running_loop()
+
+        for sock in sockets:
+            sock.setblocking(False)
+            self.accept_tasks.append(loop.create_task(self.accept_loop(sock)))
+
+    async def accept_loop(self, sock: socket.socket):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            try:
+                conn, _addr = await loop.sock_accept(sock)
+            except OSError:
+                # Most likely out of file descriptors; back off rather than
+                # spinning on a socket we can't accept from.
+                self.log.error(f"While accepting connection; {traceback.format_exc()}")
+                await asyncio.sleep(0.1)
+                continue
 
-        return asyncio.start_server(
-            self.handle_connection,
-            port=self.config.port,
-            ssl=self.ssl_context,
+            task = loop.create_task(self.handle_socket(conn))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def shutdown(self, timeout: Optional[float]):
+        # Stops accepting connections, then gives the ones in progress up to
+        # timeout seconds to finish before cutting them off.
+        for task in self.accept_tasks:
+            task.cancel()
+
+        for sock in self.sockets or []:
+            sock.close()
+
+        if self.tasks:
+            self.log.info(f"Waiting for {len(self.tasks)} connections to finish")
+            _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+
+            if pending:
+                self.log.warning(f"Closing {len(pending)} unfinished connections")
+                for task in pending:
+                    task.cancel()
+
+                await asyncio.wait(pending)
+
+        await self.config.close()
+
+        await asyncio.get_running_loop().run_in_executor(None, self.access_log.close)
+        self.executor.shutdown(wait=False)
+
+    async def watch_loop(self, interval: float = 0.1):
+        # Anything which holds the event loop (a blocking call, or just too
+        # much work between awaits) shows up as this sleep running long.
+        loop = asyncio.get_running_loop()
+
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+
+            lag = loop.time() - start - interval
+            if lag > 0:
+                self.loop_blocked_seconds += lag
+
+    def collect_metrics(self) -> Iterable[Metric]:
+        # Metrics for everything counted elsewhere anyway.
+        gauge = Gauge("amethyst_open_connections", "Connections currently open.")
+        gauge.set(self.connections)
+        yield gauge
+
+        counter = Counter(
+            "amethyst_rejected_connections_total",
+            "Connections turned away for being over max_connections.",
+        )
+        counter.inc(amount=self.rejected_connections)
+        yield counter
+
+        counter = Counter(
+            "amethyst_timeouts_total", "Connections timed out, by stage.", ("stage",)
+        )
+        for stage, count in self.timeouts.items():
+            counter.inc((stage,), count)
+        yield counter
+
+        counter = Counter(
+            "amethyst_tls_handshakes_total",
+            "Completed TLS handshakes, by whether a session was resumed.",
+            ("kind",),
+        )
+        for kind, count in self.handshakes.items():
+            counter.inc((kind,), count)
+        yield counter
+
+        counter = Counter(
+            "amethyst_access_log_dropped_total",
+            "Access log entries dropped for want of buffer space.",
+        )
+        counter.inc(amount=self.access_log.dropped)
+        yield counter
+
+        counter = Counter(
+            "amethyst_loop_blocked_seconds_total",
+            "Time the event loop spent running late.",
+        )
+        counter.inc(amount=self.loop_blocked_seconds)
+        yield counter
+
+        rate_limited = Counter(
+            "amethyst_rate_limited_total",
+            "Requests refused by a host's rate limit.",
+            ("host",),
+        )
+        expiry = Gauge(
+            "amethyst_certificate_expiry_seconds",
+            "Seconds until each host's certificate expires.",
+            ("host",),
         )
+        now = datetime.datetime.now()
+
+        cache_labels = ("host", "path", "cache")
+        cache_metrics = {
+            "entries": Gauge(
+                "amethyst_cache_entries", "Entries in each cache.", cache_labels
+            ),
+            "bytes": Gauge(
+                "amethyst_cache_bytes", "Bytes held by each cache.", cache_labels
+            ),
+            "hits": Counter("amethyst_cache_hits_total", "Cache hits.", cache_labels),
+            "misses": Counter(
+                "amethyst_cache_misses_total", "Cache misses.", cache_labels
+            ),
+            "evictions": Counter(
+                "amethyst_cache_evictions_total", "Cache evictions.", cache_labels
+            ),
+        }
+
+        for host in self.config.hosts:
+            if host.rate_limit is not None:
+                rate_limited.inc((host.host,), host.rate_limit.rejected)
+
+            if host.tls.not_valid_after is not None:
+                remaining = host.tls.not_valid_after - now
+                expiry.set(remaining.total_seconds(), (host.host,))
+
+            for path, resource in host.path_map.items():
+                caches = getattr(resource, "caches", None)
+                if caches is None:
+                    continue
+
+                for name, cache in caches().items():
+                    for key, value in cache.stats().items():
+                        cache_metrics[key].inc((host.host, path, name), value)
+
+        yield rate_limited
+        yield expiry
+        yield from cache_metrics.values()
+
+    async def handle_socket(self, sock: socket.socket):
+        loop = asyncio.get_running_loop()
+
+        # The request line is at most 1024 bytes plus CRLF; the reader
+        # won't buffer past that looking for the end of it.
+        reader = asyncio.StreamReader(limit=MAX_URL_LENGTH)
+        protocol = asyncio.StreamReaderProtocol(reader)
+
+        self.connections += 1
+        self.connections_total.inc()
+        start = time.perf_counter()
+
+        try:
+            try:
+                transport, _ = await loop.connect_accepted_socket(
+                    lambda: protocol,
+                    sock,
+                    ssl=self.ssl_context,
+                    ssl_handshake_timeout=self.config.handshake_timeout,
+                )
+
+            except ConnectionAbortedError:
+                # asyncio aborts handshakes which run over the timeout
+                self.timeouts["handshake"] += 1
+                sock.close()
+                return
+
+            except (OSError, ssl.SSLError) as e:
+                self.log.debug(f"TLS handshake failed: {e!r}")
+                sock.close()
+                return
+
+            self.stage_seconds.observe(time.perf_counter() - start, STAGE_HANDSHAKE)
+
+            ssl_object = transport.get_extra_info("ssl_object")
+            if ssl_object is not None and ssl_object.session_reused:
+                self.handshakes["resumed"] += 1
+            else:
+                self.handshakes["full"] += 1
+
+            writer = asyncio.StreamWriter(
+                cast(asyncio.WriteTransport, transport), protocol, reader, loop
+            )
+            await self.handle_connection(reader, writer)
+
+        finally:
+            self.connections -= 1
 
     async def handle_connection(self, reader, writer):
         from .request import Connection
@@ -42,19 +319,45 @@ class Server:
         peer_addr = writer.get_extra_info("peername")
         peer_cert = writer.get_extra_info("peercert")
 
-        self.log.debug(f"Received connection from {peer_addr}")
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(f"Received connection from {peer_addr}")
 
         url = "-"
+        conn = None
+        start = time.perf_counter()
+
         try:
-            url = (await reader.readuntil(b"\r\n")).rstrip(b"\r\n").decode()
+            max_connections = self.config.max_connections
+            if max_connections is not None and self.connections > max_connections:
+                # Turn the client away before even reading its request.
+                self.rejected_connections += 1
+                response = Response(Status.SLOW_DOWN, "1")
 
-            if len(url) > 1024:
-                response = Response(Status.BAD_REQUEST, "URL too long!")
             else:
-                response = await self.config.handler(
-                    url, Connection(self, peer_addr, peer_cert)
+                try:
+                    line = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n"), self.config.request_timeout
+                    )
+                except asyncio.TimeoutError:
+                    self.timeouts["request"] += 1
+                    self.log.debug(f"Timed out reading request from {peer_addr}")
+                    writer.transport.abort()
+                    return
+
+                read_done = time.perf_counter()
+                self.stage_seconds.observe(read_done - start, STAGE_READ)
+
+                url = line.rstrip(b"\r\n").decode()
+                conn = Connection(self, peer_addr, peer_cert)
+                response = await self.config.handler(url, conn)
+
+                self.stage_seconds.observe(
+                    time.perf_counter() - read_done, STAGE_HANDLER
                 )
 
+        except asyncio.LimitOverrunError:
+            response = Response(Status.BAD_REQUEST, "URL too long!")
+
         except UnicodeDecodeError:
             response = Response(Status.BAD_REQUEST, "URL must be UTF-8")
 
@@ -66,20 +369,107 @@ class Server:
                 "Exception thrown during request processing; see server logs for details.",
             )
 
-        self.access_log.info(
-            f"{url} {response.status_code.value}[{response.status_code.name}]"
-            f" {response.meta}"
-        )
+        # Requests for hosts we don't serve are lumped together, so clients
+        # can't make up as many label values as they like.
+        host = (conn.host if conn is not None else None) or ""
+        self.responses_total.inc((host, str(response.status_code.value)))
 
+        sent = 0
+        write_start = time.perf_counter()
         try:
-            line = f"{response.status_code.value} {response.meta}\r\n".encode()
-            writer.write(line)
+            sent = await asyncio.wait_for(
+                self.write_response(writer, response), self.config.response_timeout
+            )
+
+            self.stage_seconds.observe(time.perf_counter() - write_start, STAGE_WRITE)
+            self.response_bytes.inc((host,), sent)
 
-            if response.status_code.is_success() and response.content is not None:
-                writer.write(response.content)
+        except asyncio.TimeoutError:
+            self.timeouts["response"] += 1
+            self.log.debug(f"Timed out writing response to {peer_addr}")
+            writer.transport.abort()
+
+        except CGITimeoutError as e:
+            # The script, not the client, was too slow; the client gets
+            # however much of the body there was, then the connection cut.
+            self.timeouts["cgi"] += 1
+            sent = len(response.header) + e.body_bytes
+            self.log.debug(f"{e}; cutting off response to {peer_addr}")
+            writer.transport.abort()
+
+        except asyncio.CancelledError:
+            # Cut off by shutdown; don't bother flushing what's buffered.
+            writer.transport.abort()
+            raise
 
         except Exception:
             self.log.error(f"While writing response; {traceback.format_exc()}")
 
         finally:
+            if response.content is not None:
+                await self.close_body(response.content)
+
             writer.close()
+
+            self.access_log.record(
+                AccessLogEntry(
+                    time.time(),
+                    peer_addr[0] if peer_addr else "-",
+                    host,
+                    url,
+                    response.status_code.value,
+                    response.meta,
+                    sent,
+                    time.perf_counter() - start,
+                )
+            )
+
+    async def write_response(self, writer, response: Response) -> int:
+        # Returns the number of bytes written.
+        header = response.header
+        content = response.content
+
+        if content is None or not response.status_code.is_success():
+            writer.write(header)
+            return len(header)
+
+        if isinstance(content, bytes) and len(content) <= SMALL_BODY_SIZE:
+            writer.write(header + content)
+            await writer.drain()
+            return len(header) + len(content)
+
+        writer.write(header)
+        return len(header) + await self.write_body(writer, content)
+
+    async def write_body(self, writer, content: Body) -> int:
+        sent = 0
+
+        if isinstance(content, bytes):
+            writer.write(content)
+            sent = len(content)
+
+        elif isinstance(content, FileBody):
+            # Uses sendfile(2) when the transport allows it; over TLS, asyncio
+            # falls back to reading the file in bounded chunks, draining the
+            # transport between each one.
+            loop = asyncio.get_running_loop()
+            sent = await loop.sendfile(writer.transport, content.file, fallback=True)
+
+        else:
+            async for chunk in content:
+                writer.write(chunk)
+                sent += len(chunk)
+                await writer.drain()
+
+        await writer.drain()
+        return sent
+
+    @staticmethod
+    async def close_body(content: Body):
+        if isinstance(content, FileBody):
+            content.close()
+
+        elif hasattr(content, "aclose"):
+            # Finalize async generators that were cut short (or never
+            # started), so they can release whatever they hold.
+            await content.aclose()
@@ -7,10 +7,10 @@ import traceback
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
 
 
-from typing import List, TYPE_CHECKING
+from typing import Callable, List, Sequence, Tuple, Union, TYPE_CHECKING
 
 if TYPE_CHECKING:
     from .config import Config
@@ -18,6 +18,14 @@ if TYPE_CHECKING:
 
 log = logging.getLogger("amethyst.tls")
 
+# Key types we can generate certificates for. ECDSA keys are P-256, which
+# makes for much cheaper handshakes (and key generation) than RSA-4096.
+KEY_TYPES = ("rsa", "ecdsa", "ed25519")
+
+PrivateKey = Union[
+    rsa.RSAPrivateKey, ec.EllipticCurvePrivateKey, ed25519.Ed25519PrivateKey
+]
+
 
 def make_partial_context():
     c = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
@@ -28,69 +36,130 @@ def make_partial_context():
     return c
 
 
-def make_context(cert_path: str, key_path: str):
+def make_context(
+    cert_path: str, key_path: str, extra_chains: Sequence[Tuple[str, str]] = ()
+):
+    # OpenSSL keeps one certificate per key type, so loading e.g. an ECDSA
+    # chain alongside an RSA one lets each client pick what it supports.
     c = make_partial_context()
     c.load_cert_chain(cert_path, keyfile=key_path)
+
+    for extra_cert_path, extra_key_path in extra_chains:
+        c.load_cert_chain(extra_cert_path, keyfile=extra_key_path)
+
     return c
 
 
-def make_sni_context(config: "Config"):
+def make_sni_context(get_config: Callable[[], "Config"]):
+    # The configuration is looked up on every handshake, rather than once
+    # here, so that reloading it takes effect without a new context.
     def sni_callback(sock, host, _original_ctx):
-        for host_cfg in config.hosts:
-            if host_cfg.host == host:
-                break
-        else:
+        host_cfg = get_config().hosts_by_name.get(host)
+        if host_cfg is None:
             return ssl.ALERT_DESCRIPTION_HANDSHAKE_FAILURE
 
         try:
-            sock.context = host_cfg.tls.get_ssl_context()
+            context = host_cfg.tls.get_ssl_context()
         except Exception:
             log.warn(f"When setting context after SNI; {traceback.format_exc()}")
+            return ssl.ALERT_DESCRIPTION_INTERNAL_ERROR
 
+        if context is None:
+            # Still being loaded for the first time.
+            return ssl.ALERT_DESCRIPTION_HANDSHAKE_FAILURE
+
+        sock.context = context
+
+    # This is the context every connection starts out with, so it's the one
+    # whose session cache and ticket keys are used for resumption, whatever
+    # context the SNI callback switches to. Keeping it alive (and creating
+    # it before forking workers) is what lets clients resume sessions.
     c = make_partial_context()
     c.sni_callback = sni_callback
+
+    config = get_config()
+    if config.session_tickets:
+        c.num_tickets = config.session_tickets
+    else:
+        c.options |= ssl.OP_NO_TICKET
+
     return c
 
 
+def generate_private_key(key_type: str) -> PrivateKey:
+    if key_type == "rsa":
+        return rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    elif key_type == "ecdsa":
+        return ec.generate_private_key(ec.SECP256R1())
+    elif key_type == "ed25519":
+        return ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise ValueError(f"Unknown key type {key_type!r}")
+
+
+def read_expiry(cert_path: str) -> datetime.datetime:
+    with open(cert_path, "rb") as f:
+        return x509.load_pem_x509_certificate(f.read()).not_valid_after
+
+
 def update_certificate(
-    cert_path: str, key_path: str, hosts: List[str]
+    cert_path: str,
+    key_path: str,
+    hosts: List[str],
+    key_type: str = "rsa",
+    renew_before: datetime.timedelta = datetime.timedelta(0),
 ) -> datetime.datetime:
     # Check to make sure we actually need to update the certificate
     if os.path.exists(cert_path):
         with open(cert_path, "rb") as f:
             cert = x509.load_pem_x509_certificate(f.read())
 
-        if cert.not_valid_after > datetime.datetime.now():
+        if cert.not_valid_after - renew_before > datetime.datetime.now():
             log.info("Certificate exists and is unexpired; skipping regeneration.")
             return cert.not_valid_after
 
         else:
-            log.info("Certificate expired; regenerating.")
+            log.info("Certificate expired or expiring soon; regenerating.")
 
     else:
         log.info("Certificate does not exist yet, generating one now.")
 
+    key: PrivateKey
+
     # Preserve the private key if it exists
     if os.path.exists(key_path):
         with open(key_path, "rb") as f:
-            key = serialization.load_pem_private_key(f.read(), password=None)
+            existing = serialization.load_pem_private_key(f.read(), password=None)
+
+        # Whatever type of key is there gets used, even if it's not the
+        # one configured; that only decides what new keys are made with.
+        if not isinstance(
+            existing,
+            (rsa.RSAPrivateKey, ec.EllipticCurvePrivateKey, ed25519.Ed25519PrivateKey),
+        ):
+            log.critical(
+                "Key already exists, but isn't a supported type. Can't continue."
+            )
 
-        if not isinstance(key, rsa.RSAPrivateKey):
-            log.critical("Key already exists, but isn't RSA. Can't continue.")
+            raise ValueError("Existing private key is not RSA, ECDSA or Ed25519!")
 
-            raise ValueError("Existing private key is not RSA!")
+        key = existing
 
     else:
-        key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=4096,
-        )
+        key = generate_private_key(key_type)
+
+        # Ed25519 keys have no "traditional" encoding; RSA keys keep using it
+        # so that they stay readable by whatever read them before.
+        if isinstance(key, rsa.RSAPrivateKey):
+            key_format = serialization.PrivateFormat.TraditionalOpenSSL
+        else:
+            key_format = serialization.PrivateFormat.PKCS8
 
         with open(key_path, "wb") as f:
             f.write(
                 key.private_bytes(
                     encoding=serialization.Encoding.PEM,
-                    format=serialization.PrivateFormat.TraditionalOpenSSL,
+                    format=key_format,
                     encryption_algorithm=serialization.NoEncryption(),
                 )
             )
@@ -110,7 +179,10 @@ def update_certificate(
             x509.SubjectAlternativeName([x509.DNSName(host) for host in hosts]),
             critical=False,
         )
-        .sign(key, hashes.SHA256())
+        .sign(
+            key,
+            None if isinstance(key, ed25519.Ed25519PrivateKey) else hashes.SHA256(),
+        )
     )
 
     with open(cert_path, "wb") as f:
@@ -1,3 +1,10 @@
+import dataclasses
+
+from typing import Type, TypeVar, cast
+
+T = TypeVar("T")
+
+
 def get_path_components(path):
     path = path.strip("/").split("/")
     path = [c for c in path if c]
@@ -15,3 +22,19 @@ def get_path_components(path):
             normalized.append(comp)
 
     return normalized
+
+
+def add_slots(cls: Type[T]) -> Type[T]:
+    # Does for a dataclass what @dataclass(slots=True) does on Python 3.10
+    # and up: recreates the class with a slot per field, and without the
+    # class attributes holding defaults (__init__ has its own copy).
+    names = tuple(f.name for f in dataclasses.fields(cls))
+
+    namespace = dict(cls.__dict__)
+    namespace["__slots__"] = names
+    for name in names + ("__dict__", "__weakref__"):
+        namespace.pop(name, None)
+
+    slotted = type(cls.__name__, cls.__bases__, namespace)
+    slotted.__qualname__ = cls.__qualname__
+    return cast(Type[T], slotted)
@@ -15,6 +15,8 @@ setup(
         ],
         "amethyst.resources": [
             "filesystem = amethyst.resource:FilesystemResource",
+            "app = amethyst.app:AppResource",
+            "scgi = amethyst.scgi:SCGIResource",
         ],
     },
     install_requires=[